@@ -0,0 +1,68 @@
+import logging
+
+from sqlalchemy import select
+
+from database import Admin
+
+log = logging.getLogger(__name__)
+
+# Chat member statuses of the group administrators
+ADMIN_STATUSES = ("administrator", "creator")
+
+
+class AdminRoster:
+    """The users allowed to run admin commands, kept in memory so that checks need no Telegram call.
+
+    The roster is the union of the admins table and the administrators of the group; the latter are refreshed
+    in the background and on chat member updates, and the last known list is kept if Telegram is unreachable.
+    Until the administrators could be loaded once, checks ask Telegram directly instead of denying them."""
+
+    def __init__(self, session_factory):
+        self.session_factory = session_factory
+        # user_id -> Admin row, with its permissions
+        self.stored = {}
+        # user ids of the administrators of the group
+        self.group = set()
+        # whether self.group was ever loaded from Telegram
+        self.loaded = False
+
+    async def load(self):
+        """Seed the roster from the admins table."""
+        async with self.session_factory() as session:
+            result = await session.execute(select(Admin))
+            self.stored = {admin.user_id: admin for admin in result.scalars()}
+        log.debug(f"Loaded {len(self.stored)} admins from the database")
+
+    async def refresh(self, bot, chat_id):
+        """Reload the administrators of the group from Telegram."""
+        try:
+            chat_admins = await bot.get_chat_administrators(chat_id) or []
+        except Exception as e:
+            log.warning(f"Could not refresh the group administrators, keeping the last known ones: {e}")
+            return
+        self.group = {admin.user.id for admin in chat_admins}
+        self.loaded = True
+
+    def update_status(self, user_id, status: str):
+        """Update the roster from a chat member status of the group."""
+        if status in ADMIN_STATUSES:
+            self.group.add(user_id)
+        else:
+            self.group.discard(user_id)
+
+    def is_admin(self, user_id) -> bool:
+        return user_id in self.stored or user_id in self.group
+
+    async def check(self, bot, chat_id, user_id) -> bool:
+        """is_admin, loading the administrators of the group first if they never could be."""
+        if not self.loaded and user_id not in self.stored:
+            await self.refresh(bot, chat_id)
+        return self.is_admin(user_id)
+
+    def is_owner(self, user_id) -> bool:
+        admin = self.stored.get(user_id)
+        return admin is not None and bool(admin.is_owner)
+
+    def can_block_users(self, user_id) -> bool:
+        admin = self.stored.get(user_id)
+        return admin is not None and bool(admin.block_users or admin.is_owner)
@@ -0,0 +1,364 @@
+import asyncio
+import datetime
+import json
+import logging
+import time
+
+from sqlalchemy import select, update, insert, func
+from telegram.error import RetryAfter, Forbidden, TimedOut, NetworkError, TelegramError
+
+from database import User, BroadcastJob, BroadcastRecipient
+
+log = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Allow at most rate operations per second on average, with bursts of up to capacity operations."""
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        """Stop handing out tokens for a while, e.g. after Telegram asked to slow down."""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+
+class BroadcastProgress:
+    def __init__(self, total: int = None):
+        self.total = total
+        self.sent = 0
+        self.blocked = 0
+        self.failed = 0
+        self.started = time.monotonic()
+
+    @property
+    def done(self) -> int:
+        return self.sent + self.blocked + self.failed
+
+    @property
+    def rate(self) -> float:
+        elapsed = time.monotonic() - self.started
+        return self.done / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def eta(self):
+        """Seconds left until the broadcast completes, None if unknown."""
+        if self.total is None or not self.rate:
+            return None
+        return max(self.total - self.done, 0) / self.rate
+
+    def __str__(self):
+        text = f"Sent: {self.sent}\n" \
+               f"Blocked: {self.blocked}\n" \
+               f"Failed: {self.failed}\n" \
+               f"Done: {self.done}" + (f"/{self.total}" if self.total is not None else "") + "\n" \
+               f"Speed: {self.rate:.1f} msg/s"
+        if self.eta is not None:
+            text += f"\nETA: {int(self.eta // 60)}m {int(self.eta % 60)}s"
+        return text
+
+
+class Broadcaster:
+    """Copy a message to many users as fast as Telegram allows.
+
+    A bounded pool of senders shares a global token bucket; a RetryAfter pauses every sender for the time
+    Telegram asks for, and users who blocked the bot are counted instead of retried."""
+
+    def __init__(self, rate: float = 25, concurrency: int = 8, max_retries: int = 3):
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        # shared by every broadcast, as the Telegram limits are per bot
+        self.bucket = TokenBucket(rate)
+
+    async def send(self, bot, chat_id, from_chat_id, message_id) -> str:
+        """Copy the message to a single user, returning the outcome: sent, blocked or failed."""
+        bucket = self.bucket
+        attempts = 0
+        while True:
+            await bucket.acquire()
+            try:
+                await bot.copy_message(chat_id=chat_id, from_chat_id=from_chat_id, message_id=message_id)
+                return "sent"
+            except RetryAfter as e:
+                log.warning(f"Flood limit hit, pausing the broadcast for {e.retry_after} seconds")
+                bucket.pause(e.retry_after)
+            except Forbidden:
+                return "blocked"
+            except (TimedOut, NetworkError) as e:
+                attempts += 1
+                if attempts > self.max_retries:
+                    log.debug(f"Giving up broadcasting to {chat_id}: {e}")
+                    return "failed"
+            except TelegramError as e:
+                log.debug(f"Could not broadcast to {chat_id}: {e}")
+                return "failed"
+
+    async def run(self, bot, from_chat_id, message_id, user_ids, *,
+                  total: int = None, progress: BroadcastProgress = None,
+                  on_progress=None, progress_interval: float = 10,
+                  on_result=None) -> BroadcastProgress:
+        """Copy the message to every user of user_ids, an iterable or async iterable of chat ids.
+
+        on_progress(progress) is awaited every progress_interval seconds, on_result(user_id, outcome) after
+        every single message. Passing progress keeps counting on it, e.g. across the batches of a job."""
+        if progress is None:
+            progress = BroadcastProgress(total)
+        queue = asyncio.Queue(maxsize=self.concurrency * 2)
+
+        async def produce():
+            if hasattr(user_ids, "__aiter__"):
+                async for user_id in user_ids:
+                    await queue.put(user_id)
+            else:
+                for user_id in user_ids:
+                    await queue.put(user_id)
+            for _ in range(self.concurrency):
+                await queue.put(None)
+
+        async def consume():
+            while (user_id := await queue.get()) is not None:
+                outcome = await self.send(bot, user_id, from_chat_id, message_id)
+                setattr(progress, outcome, getattr(progress, outcome) + 1)
+                if on_result is not None:
+                    await on_result(user_id, outcome)
+
+        async def report():
+            while True:
+                await asyncio.sleep(progress_interval)
+                try:
+                    await on_progress(progress)
+                except Exception as e:
+                    log.debug(f"Could not report the broadcast progress: {e}")
+
+        # A failing producer or consumer stops the others, instead of leaving them blocked on the queue
+        # (asyncio.TaskGroup would do the same, but the Docker image still runs Python 3.10)
+        tasks = [asyncio.create_task(produce())] + [asyncio.create_task(consume()) for _ in range(self.concurrency)]
+        if on_progress is not None:
+            tasks.append(asyncio.create_task(report()))
+        try:
+            await asyncio.gather(*tasks[:self.concurrency + 1])
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        return progress
+
+
+class SegmentError(Exception):
+    def __init__(self, message="Invalid broadcast segment"):
+        self.message = message
+        super().__init__(self.message)
+
+
+class Segment:
+    """The filters selecting the users a broadcast is sent to; users who blocked the bot are always left out.
+
+    Written as words after /broadcast: joined, verified, wallet, notblocked, lang=<code>, since=<YYYY-MM-DD>,
+    until=<YYYY-MM-DD>. notblocked leaves out the users blocked by an admin."""
+
+    FLAGS = ("joined", "verified", "wallet", "notblocked")
+    OPTIONS = ("lang", "since", "until")
+
+    def __init__(self, **filters):
+        self.filters = filters
+
+    @classmethod
+    def parse(cls, words) -> "Segment":
+        filters = {}
+        for word in words:
+            key, _, value = word.partition("=")
+            if key in cls.FLAGS and not value:
+                filters[key] = True
+            elif key in cls.OPTIONS and value:
+                if key in ("since", "until"):
+                    try:
+                        datetime.date.fromisoformat(value)
+                    except ValueError:
+                        raise SegmentError(f"Invalid date {value}, use YYYY-MM-DD")
+                filters[key] = value
+            else:
+                raise SegmentError(f"Unknown filter {word}\n"
+                                   f"Available filters: {', '.join(cls.FLAGS)}, "
+                                   f"{', '.join(f'{option}=...' for option in cls.OPTIONS)}")
+        return cls(**filters)
+
+    def to_json(self) -> str:
+        return json.dumps(self.filters)
+
+    @classmethod
+    def from_json(cls, data: str) -> "Segment":
+        return cls(**json.loads(data)) if data else cls()
+
+    def where(self) -> list:
+        conditions = [User.bot_blocked == False]
+        if self.filters.get("notblocked"):
+            conditions.append(User.blocked == False)
+        if self.filters.get("joined"):
+            conditions.append(User.joined == True)
+        if self.filters.get("verified"):
+            conditions.append(User.verified == True)
+        if self.filters.get("wallet"):
+            conditions.append(User.wallet.isnot(None))
+        if "lang" in self.filters:
+            conditions.append(User.language == self.filters["lang"])
+        if "since" in self.filters:
+            since = datetime.date.fromisoformat(self.filters["since"])
+            conditions.append(User.created_at >= datetime.datetime.combine(since, datetime.time.min))
+        if "until" in self.filters:
+            until = datetime.date.fromisoformat(self.filters["until"])
+            conditions.append(User.created_at < datetime.datetime.combine(until, datetime.time.min))
+        return conditions
+
+    def __str__(self):
+        if not self.filters:
+            return "all users"
+        return " ".join(key if value is True else f"{key}={value}" for key, value in self.filters.items())
+
+
+class BroadcastJobs:
+    """Run broadcasts as jobs persisted in the database, which are resumed after a restart.
+
+    Recipients are processed in batches in user id order: the batch is stored as pending before being sent, and
+    the outcomes and the job cursor are stored once the batch is done. A batch interrupted by a restart is not
+    sent again, so no user ever receives a message twice; users who blocked the bot are flagged and skipped by
+    the following broadcasts."""
+
+    def __init__(self, session_factory, broadcaster: Broadcaster, cache=None, batch_size: int = 500,
+                 progress_interval: float = 10):
+        self.session_factory = session_factory
+        self.cache = cache
+        self.broadcaster = broadcaster
+        self.batch_size = batch_size
+        self.progress_interval = progress_interval
+
+    async def create(self, bot, admin_chat_id, from_chat_id, message_id, segment: Segment = None) -> int:
+        segment = segment or Segment()
+        async with self.session_factory() as session:
+            total = await session.scalar(select(func.count(User.user_id)).where(*segment.where()))
+            status = await bot.send_message(chat_id=admin_chat_id, text=f"Broadcast to {segment} started")
+            job = BroadcastJob(from_chat_id=from_chat_id,
+                               message_id=message_id,
+                               admin_chat_id=admin_chat_id,
+                               status_message_id=status.message_id,
+                               segment=segment.to_json(),
+                               total=total)
+            session.add(job)
+            await session.commit()
+            return job.job_id
+
+    async def resume_all(self, bot):
+        """Resume the jobs interrupted by a restart."""
+        async with self.session_factory() as session:
+            result = await session.execute(select(BroadcastJob.job_id).where(BroadcastJob.status == "running"))
+            job_ids = result.scalars().all()
+        for job_id in job_ids:
+            log.info(f"Resuming broadcast job {job_id}")
+            await self.run(bot, job_id)
+
+    async def _next_batch(self, segment: Segment, cursor) -> list:
+        """Read the next user ids of the segment after cursor; only the ids are loaded, never whole users."""
+        statement = select(User.user_id).where(*segment.where()).order_by(User.user_id).limit(self.batch_size)
+        if cursor is not None:
+            statement = statement.where(User.user_id > cursor)
+        async with self.session_factory() as session:
+            result = await session.execute(statement)
+            return result.scalars().all()
+
+    async def _recover(self, session, job: BroadcastJob):
+        """Settle the batch that was being sent when the bot stopped."""
+        await session.execute(
+            update(BroadcastRecipient)
+            .where(BroadcastRecipient.job_id == job.job_id, BroadcastRecipient.outcome == "pending")
+            .values(outcome="unknown")
+        )
+        last = await session.scalar(
+            select(func.max(BroadcastRecipient.user_id)).where(BroadcastRecipient.job_id == job.job_id)
+        )
+        if last is not None and (job.cursor is None or last > job.cursor):
+            job.cursor = last
+        await session.commit()
+
+    async def run(self, bot, job_id: int) -> BroadcastProgress:
+        async with self.session_factory() as session:
+            job = await session.get(BroadcastJob, job_id)
+            await self._recover(session, job)
+
+        progress = BroadcastProgress(job.total)
+        progress.sent, progress.blocked, progress.failed = job.sent, job.blocked, job.failed
+
+        async def report(progress):
+            await bot.edit_message_text(chat_id=job.admin_chat_id,
+                                        message_id=job.status_message_id,
+                                        text=f"Broadcast in progress\n\n{progress}")
+
+        segment = Segment.from_json(job.segment)
+        cursor = job.cursor
+        while user_ids := await self._next_batch(segment, cursor):
+            async with self.session_factory() as session:
+                await session.execute(
+                    insert(BroadcastRecipient),
+                    [{"job_id": job_id, "user_id": user_id, "outcome": "pending"} for user_id in user_ids]
+                )
+                await session.commit()
+
+            outcomes = {}
+
+            async def on_result(user_id, outcome):
+                outcomes.setdefault(outcome, []).append(user_id)
+
+            await self.broadcaster.run(bot, job.from_chat_id, job.message_id, user_ids,
+                                       progress=progress,
+                                       on_progress=report,
+                                       progress_interval=self.progress_interval,
+                                       on_result=on_result)
+
+            cursor = user_ids[-1]
+            async with self.session_factory() as session:
+                for outcome, ids in outcomes.items():
+                    await session.execute(
+                        update(BroadcastRecipient)
+                        .where(BroadcastRecipient.job_id == job_id, BroadcastRecipient.user_id.in_(ids))
+                        .values(outcome=outcome)
+                    )
+                if "blocked" in outcomes:
+                    await session.execute(
+                        update(User).where(User.user_id.in_(outcomes["blocked"])).values(bot_blocked=True)
+                        .execution_options(synchronize_session=False)
+                    )
+                await session.execute(
+                    update(BroadcastJob).where(BroadcastJob.job_id == job_id)
+                    .values(cursor=cursor, sent=progress.sent, blocked=progress.blocked, failed=progress.failed)
+                )
+                await session.commit()
+            if self.cache is not None:
+                for user_id in outcomes.get("blocked", []):
+                    self.cache.invalidate(user_id)
+
+        async with self.session_factory() as session:
+            await session.execute(
+                update(BroadcastJob).where(BroadcastJob.job_id == job_id).values(status="completed")
+            )
+            await session.commit()
+
+        await bot.send_message(chat_id=job.admin_chat_id, text=f"Broadcast completed!\n\n{progress}")
+        return progress
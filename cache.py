@@ -1,68 +1,221 @@
-from cachetools import TTLCache
-import sqlalchemy
+import time
+
+from cachetools import Cache as _Cache, TTLCache, LRUCache, LFUCache
+from sqlalchemy import select, update
+from sqlalchemy.orm import joinedload
 
 from database import User
 
 
+class _Instrumented:
+    """Mixin counting the items a cachetools cache throws away."""
+
+    def __init__(self, *args, **kwargs):
+        self.evictions = 0
+        self.expirations = 0
+        super().__init__(*args, **kwargs)
+
+    def popitem(self):
+        # cachetools calls popitem only when the cache is full and something has to go
+        item = super().popitem()
+        self.evictions += 1
+        return item
+
+
+class _InstrumentedTTLCache(_Instrumented, TTLCache):
+    def expire(self, time=None):
+        # expire() only returns the expired items from cachetools 5.4 on, count them by size instead
+        # (the size of the storage, as len() of a TTLCache expires items itself)
+        size = _Cache.__len__(self)
+        expired = super().expire(time)
+        self.expirations += size - _Cache.__len__(self)
+        return expired
+
+
+class _InstrumentedLRUCache(_Instrumented, LRUCache):
+    pass
+
+
+class _InstrumentedLFUCache(_Instrumented, LFUCache):
+    pass
+
+
+def create_user_cache(policy="ttl", maxsize=10000, ttl=60):
+    """Create the backing store of the user cache for the given eviction policy."""
+    if policy == "ttl":
+        return _InstrumentedTTLCache(maxsize=maxsize, ttl=ttl)
+    elif policy == "lru":
+        return _InstrumentedLRUCache(maxsize=maxsize)
+    elif policy == "lfu":
+        return _InstrumentedLFUCache(maxsize=maxsize)
+    else:
+        raise ValueError("Invalid cache policy. Supported policies: 'ttl', 'lru', 'lfu'")
+
+
 class Cache:
-    def __init__(self, engine):
-        # Create a cache with a time-to-live (TTL) of 60 seconds (1 minute)
-        self.engine = engine
-        self.user_cache = TTLCache(maxsize=100, ttl=60)
-        # self.session = sqlalchemy.orm.sessionmaker(bind=self.engine)()
+    def __init__(self, session_factory, policy="ttl", maxsize=10000, ttl=60):
+        self.session_factory = session_factory
+        self.user_cache = create_user_cache(policy, maxsize, ttl)
+        self.policy = policy
+        # runtime counters, see stats()
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.load_time = 0.0
 
     # Function to retrieve a user from the cache or from the database if not present
-    def get_user(self, user_id):
+    async def get_user(self, user_id):
         # Try to get the user from the cache
         user = self.user_cache.get(user_id)
 
         if user is not None:
+            self.hits += 1
             return user
 
+        self.misses += 1
+
         # If the user is not in the cache, retrieve it from the database
-        session = sqlalchemy.orm.sessionmaker(bind=self.engine)()
-        user = session.query(User).filter_by(user_id=user_id).first()
+        started = time.perf_counter()
+        async with self.session_factory() as session:
+            # referred_by is loaded eagerly, lazy loads are not possible once the user leaves the session
+            result = await session.execute(
+                select(User).where(User.user_id == user_id).options(joinedload(User.referred_by))
+            )
+            user = result.scalars().first()
 
         if user is not None:
             # Add the user to the cache
-            user.referred_by
-            user.referred_users
             self.user_cache[user_id] = user
-        session.close()
+        self._record_load(started)
 
         return user
 
+    # Function to retrieve many users at once, loading all the missing ones with a single query
+    async def get_users(self, user_ids):
+        users = {}
+        missing = []
+        for user_id in dict.fromkeys(user_ids):
+            user = self.user_cache.get(user_id)
+            if user is not None:
+                self.hits += 1
+                users[user_id] = user
+            else:
+                self.misses += 1
+                missing.append(user_id)
+
+        if not missing:
+            return users
+
+        started = time.perf_counter()
+        async with self.session_factory() as session:
+            result = await session.execute(
+                select(User).where(User.user_id.in_(missing)).options(joinedload(User.referred_by))
+            )
+            for user in result.scalars():
+                self.user_cache[user.user_id] = user
+                users[user.user_id] = user
+        self._record_load(started)
+
+        return users
+
     # Function to update a user in both the database and the cache
-    def update_user(self, user_id, updated_data):
-        # Update the user in the database (replace with your actual database update logic)
-        session = sqlalchemy.orm.sessionmaker(bind=self.engine)()
-        session.query(User).filter_by(user_id=user_id).update(updated_data)
-        session.commit()
-
-        # Update the user in the cache if it exists
-        if user_id in self.user_cache:
-            user = session.query(User).filter_by(user_id=user_id).first()
-            user.referred_by
-            user.referred_users
-            self.user_cache[user_id] = user
+    async def update_user(self, user_id, updated_data):
+        async with self.session_factory() as session:
+            await session.execute(
+                update(User).where(User.user_id == user_id).values(updated_data)
+                .execution_options(synchronize_session=False)
+            )
+            await session.commit()
+
+            # Update the user in the cache if it exists
+            if user_id in self.user_cache:
+                started = time.perf_counter()
+                result = await session.execute(
+                    select(User).where(User.user_id == user_id).options(joinedload(User.referred_by))
+                )
+                self.user_cache[user_id] = result.scalars().first()
+                self._record_load(started)
+
+    # Function to create a new user, counting it as a referral of the user who referred it
+    async def create_user(self, telegram_user, referred_by_id, language):
+        async with self.session_factory() as session:
+            session.add(User(telegram_user, referred_by_id=referred_by_id, language=language))
+            if referred_by_id:
+                await session.execute(
+                    update(User).where(User.user_id == referred_by_id)
+                    .values(total_referrals_count=User.total_referrals_count + 1)
+                    .execution_options(synchronize_session=False)
+                )
+            await session.commit()
+
+        self.invalidate(referred_by_id)
+        return await self.get_user(telegram_user.id)
+
+    # Function to mark a user as joined and reward the user who referred it, in a single transaction
+    # Returns False if the user had already joined
+    async def mark_joined(self, user_id, referred_by_id, reward):
+        async with self.session_factory() as session:
+            result = await session.execute(
+                update(User).where(User.user_id == user_id, User.joined.is_(False)).values(joined=True)
+                .execution_options(synchronize_session=False)
+            )
+            joined = result.rowcount
+            if joined and referred_by_id:
+                await session.execute(
+                    update(User).where(User.user_id == referred_by_id)
+                    .values(reward=User.reward + reward,
+                            joined_referrals_count=User.joined_referrals_count + 1)
+                    .execution_options(synchronize_session=False)
+                )
+            await session.commit()
+
+        self.invalidate(user_id)
+        self.invalidate(referred_by_id)
+        return bool(joined)
+
+    # Function to drop a user from the cache, so that the next lookup reads it again from the database
+    def invalidate(self, user_id):
+        self.user_cache.pop(user_id, None)
+
+    def _record_load(self, started):
+        self.loads += 1
+        self.load_time += time.perf_counter() - started
+
+    def stats(self):
+        """Return a snapshot of the cache counters."""
+        lookups = self.hits + self.misses
+        return {
+            "policy": self.policy,
+            "size": len(self.user_cache),
+            "maxsize": self.user_cache.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.user_cache.evictions,
+            "expirations": self.user_cache.expirations,
+            "loads": self.loads,
+            "avg_load_ms": round(self.load_time / self.loads * 1000, 2) if self.loads else 0.0,
+        }
 
-        session.close()
+    def __str__(self):
+        text = ""
+        for key, val in self.stats().items():
+            text += f"{key}: {val}" '\n'
+        return text
 
 
 # if __name__ == '__main__':
-#     from main import engine
+#     from session import Session
 #
-#     cache = Cache(engine)
-#     user = cache.get_user(596604100)
+#     cache = Cache(Session)
+#     user = asyncio.run(cache.get_user(596604100))
 #     print(user)
 #     print(user.referral_link)
 #     print(user.referred_by)
-#     print(user.referred_users)
 #     print(user.joined)
 #
-#     user = cache.get_user(6895974039)
+#     user = asyncio.run(cache.get_user(6895974039))
 #     print(user)
 #     print(user.referral_link)
 #     print(user.referred_by)
-#     print(user.referred_users)
 #     print(user.joined)
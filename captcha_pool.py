@@ -0,0 +1,119 @@
+import asyncio
+import collections
+import concurrent.futures
+import logging
+import multiprocessing
+import os
+import secrets
+import uuid
+
+from captcha.image import ImageCaptcha
+
+log = logging.getLogger(__name__)
+
+# The generator of the worker process, created on its first render
+_image_captcha = None
+
+
+def render_captcha():
+    """Render a new captcha; runs in a worker process, as rendering is CPU bound.
+    Returns the answer and the PNG image bytes."""
+    global _image_captcha
+    if _image_captcha is None:
+        _image_captcha = ImageCaptcha()
+    # secrets instead of random, as forked workers would share the random state of the parent
+    answer = str(1000 + secrets.randbelow(9000))
+    return answer, _image_captcha.generate(answer).getvalue()
+
+
+class CaptchaPool:
+    """A bounded pool of pre-rendered captchas, refilled in the background by a process pool.
+
+    Verification only pops a ready captcha; when the in-memory pool runs dry during a join flood, captchas
+    spilled to spill_dir in quieter times are used, and only then one is rendered on demand."""
+
+    def __init__(self, size: int = 50, workers: int = 1, spill_dir: str = "", spill_size: int = 0):
+        self.size = size
+        self.workers = workers
+        self.spill_dir = spill_dir
+        self.spill_size = spill_size if spill_dir else 0
+        self.pool = collections.deque()
+        self.executor = None
+        self.refiller = None
+        self.wakeup = asyncio.Event()
+
+    async def start(self):
+        # The bot already runs threads (database driver, thread pool), and forking a threaded process can leave a
+        # lock held forever in the child: workers start from a fresh interpreter instead
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers,
+                                                               mp_context=multiprocessing.get_context("spawn"))
+        if self.spill_size:
+            os.makedirs(self.spill_dir, exist_ok=True)
+        self.refiller = asyncio.create_task(self._refill())
+
+    async def stop(self):
+        if self.refiller is not None:
+            self.refiller.cancel()
+            await asyncio.gather(self.refiller, return_exceptions=True)
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    async def _render(self):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, render_captcha)
+
+    def _spilled(self) -> list:
+        if not self.spill_size:
+            return []
+        return [name for name in os.listdir(self.spill_dir) if name.endswith(".captcha")]
+
+    def _spill(self, answer: str, image: bytes):
+        # The answer is stored on the first line of the file, a listing of the directory must not reveal it
+        path = os.path.join(self.spill_dir, f"{uuid.uuid4().hex}.captcha")
+        with open(path + ".tmp", "wb") as file:
+            file.write(answer.encode() + b"\n" + image)
+        # rename, so that a half written captcha is never picked up
+        os.replace(path + ".tmp", path)
+
+    def _unspill(self):
+        for name in self._spilled():
+            path = os.path.join(self.spill_dir, name)
+            try:
+                with open(path, "rb") as file:
+                    answer = file.readline().rstrip(b"\n").decode()
+                    image = file.read()
+                os.remove(path)
+            except OSError:
+                # taken by a concurrent verification
+                continue
+            return answer, image
+        return None
+
+    async def _refill(self):
+        while True:
+            try:
+                if len(self.pool) < self.size:
+                    self.pool.append(await self._render())
+                    continue
+                if len(await asyncio.to_thread(self._spilled)) < self.spill_size:
+                    answer, image = await self._render()
+                    await asyncio.to_thread(self._spill, answer, image)
+                    continue
+            except Exception as e:
+                log.error(f"Could not render a captcha: {e}")
+                await asyncio.sleep(1)
+                continue
+            self.wakeup.clear()
+            await self.wakeup.wait()
+
+    async def get(self):
+        """Return the answer and the PNG image bytes of an unused captcha."""
+        self.wakeup.set()
+        if self.pool:
+            return self.pool.popleft()
+        if self.spill_size:
+            spilled = await asyncio.to_thread(self._unspill)
+            if spilled is not None:
+                return spilled
+        log.debug("Captcha pool exhausted, rendering on demand")
+        return await self._render()
@@ -1,36 +1,114 @@
+import asyncio
 import os
 import logging
+
+import toml
+
 import nuconfig
 
 log = logging.getLogger(__name__)
-logging.root.setLevel("INFO")
-log.debug("Set logging level to INFO while the config is being loaded")
-
-# Ensure the template config file exists
-if not os.path.isfile("config/template_config.toml"):
-    log.fatal("config/template_config.toml does not exist!")
-    exit(254)
-
-# If the config file does not exist, clone the template and exit
-if not os.path.isfile("config/config.toml"):
-    log.debug("config/config.toml does not exist.")
-
-    with open("config/template_config.toml", encoding="utf8") as template_cfg_file, \
-            open("config/config.toml", "w", encoding="utf8") as user_cfg_file:
-        # Copy the template file to the config file
-        user_cfg_file.write(template_cfg_file.read())
-
-    log.fatal("A config file has been created in config/config.toml."
-                " Customize it, then restart greed!")
-    exit(1)
-
-# Compare the template config with the user-made one
-with open("config/template_config.toml", encoding="utf8") as template_cfg_file, \
-        open("config/config.toml", encoding="utf8") as user_cfg_file:
-    template_cfg = nuconfig.NuConfig(template_cfg_file)
-    user_cfg = nuconfig.NuConfig(user_cfg_file)
-    if not template_cfg.cmplog(user_cfg):
-        log.fatal("There were errors while parsing the config.toml file. Please fix them and restart greed!")
+
+TEMPLATE_PATH = "config/template_config.toml"
+
+
+class ConfigError(Exception):
+    def __init__(self, message="The config file is not valid"):
+        self.message = message
+        super().__init__(self.message)
+
+
+class ConfigService:
+    """The config file, parsed and validated against the template once, and reloaded when it changes.
+
+    Sections are read with config["Section"]["key"] from the current snapshot. A new version of the file replaces
+    the snapshot in a single assignment, and only if it is valid: a broken edit is logged and the previous
+    snapshot stays in use. Subscribers are then called with the old and the new snapshot."""
+
+    def __init__(self, path: str, template_path: str = TEMPLATE_PATH):
+        self.path = path
+        with open(template_path, encoding="utf8") as template_cfg_file:
+            self.template = nuconfig.NuConfig(template_cfg_file)
+        self.snapshot: nuconfig.NuConfig = None
+        self.mtime = None
+        self.subscribers = []
+
+    def __getitem__(self, item):
+        return self.snapshot[item]
+
+    def load(self) -> nuconfig.NuConfig:
+        """Parse and validate the file, and make it the current snapshot."""
+        # The file is not read again until it changes, even if it is not valid
+        self.mtime = os.stat(self.path).st_mtime_ns
+        try:
+            with open(self.path, encoding="utf8") as user_cfg_file:
+                snapshot = nuconfig.NuConfig(user_cfg_file)
+        except toml.TomlDecodeError as e:
+            raise ConfigError(f"Could not parse the config file: {e}") from e
+        if not self.template.cmplog(snapshot):
+            raise ConfigError("There were errors while parsing the config file")
+        self.snapshot = snapshot
+        return snapshot
+
+    def subscribe(self, callback):
+        """Call callback(old, new) after every reload, it may be a coroutine function."""
+        self.subscribers.append(callback)
+
+    async def check(self):
+        """Reload the file if it was modified since it was last read."""
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError as e:
+            log.error(f"Could not read the config file: {e}")
+            return
+        if mtime == self.mtime:
+            return
+        old = self.snapshot
+        try:
+            new = self.load()
+        except ConfigError as e:
+            log.error(f"{e.message}, keeping the previous configuration")
+            return
+        log.info("Configuration reloaded")
+        for callback in self.subscribers:
+            try:
+                result = callback(old, new)
+                if asyncio.iscoroutine(result):
+                    await result
+            except Exception as e:
+                log.error(f"Config subscriber {callback.__qualname__} failed: {e!r}")
+
+
+def load_config(path: str) -> ConfigService:
+    """Load the config file, creating it from the template and exiting if it does not exist yet."""
+    # Ensure the template config file exists
+    if not os.path.isfile(TEMPLATE_PATH):
+        log.fatal(f"{TEMPLATE_PATH} does not exist!")
+        exit(254)
+
+    # If the config file does not exist, clone the template and exit
+    if not os.path.isfile(path):
+        log.debug(f"{path} does not exist.")
+
+        with open(TEMPLATE_PATH, encoding="utf8") as template_cfg_file, \
+                open(path, "w", encoding="utf8") as user_cfg_file:
+            # Copy the template file to the config file
+            user_cfg_file.write(template_cfg_file.read())
+
+        log.fatal("A config file has been created."
+                  " Customize it, then restart greed!")
+        exit(1)
+
+    # Compare the template config with the user-made one
+    config = ConfigService(path)
+    try:
+        config.load()
+    except ConfigError as e:
+        log.fatal(f"{e.message}. Please fix them and restart greed!")
         exit(2)
-    else:
-        log.debug("Configuration parsed successfully!")
\ No newline at end of file
+    log.debug("Configuration parsed successfully!")
+    return config
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level="INFO")
+    load_config(os.environ.get("CONFIG_PATH", "config/config.toml"))
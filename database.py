@@ -1,8 +1,10 @@
 import logging
 from datetime import datetime
 
-from sqlalchemy import Column, ForeignKey
-from sqlalchemy import Integer, BigInteger, String, DateTime, Boolean
+import sqlalchemy
+from sqlalchemy import Column, ForeignKey, Index
+from sqlalchemy import Integer, BigInteger, String, DateTime, Boolean, Float
+from sqlalchemy import select, update, func, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship, backref
 
@@ -28,13 +30,21 @@ class User(TableDeclarativeBase):
     referred_by_id = Column(BigInteger, ForeignKey("users.user_id"))
     referred_by = relationship("User", backref=backref("referred_users"), remote_side="User.user_id",
                                primaryjoin="User.referred_by_id == User.user_id")
+    # denormalized referral counters, kept up to date by the handlers so referred_users never has to be loaded
+    total_referrals_count = Column(Integer, nullable=False, default=0, server_default="0")
+    joined_referrals_count = Column(Integer, nullable=False, default=0, server_default="0")
 
     # default data
     blocked = Column(Boolean, nullable=False, default=False)
+    # the user blocked the bot, found out by a broadcast and cleared when the user talks to the bot again
+    bot_blocked = Column(Boolean, nullable=False, default=False, server_default=text("false"))
     joined = Column(Boolean, nullable=False, default=False)
 
     # wallet and reward data
     wallet = Column(String)
+    # result of the last on-chain check of the wallet, None until checked
+    wallet_valid = Column(Boolean)
+    wallet_checked_at = Column(DateTime)
     reward = Column(Integer, default=0)
     claimed = Column(Integer, default=0)
 
@@ -45,6 +55,16 @@ class User(TableDeclarativeBase):
 
     # Extra table parameters
     __tablename__ = "users"
+    # The broadcast segments read the user ids in primary key order, filtered by these columns
+    __table_args__ = (
+        Index("ix_users_blocked_user_id", "blocked", "user_id"),
+        Index("ix_users_bot_blocked_user_id", "bot_blocked", "user_id"),
+        Index("ix_users_joined_user_id", "joined", "user_id"),
+        Index("ix_users_verified_user_id", "verified", "user_id"),
+        Index("ix_users_language_user_id", "language", "user_id"),
+        Index("ix_users_created_at", "created_at"),
+        Index("ix_users_referred_by_id", "referred_by_id"),
+    )
 
     def __init__(self, telegram_user, **kwargs):
         # Initialize the super
@@ -54,10 +74,9 @@ class User(TableDeclarativeBase):
         self.first_name = telegram_user.first_name
         self.last_name = telegram_user.last_name
         self.username = telegram_user.username
-        if telegram_user.language_code:
+        # The language resolved by the caller is one the bot has strings for, the raw client code may not be
+        if not kwargs.get('language'):
             self.language = telegram_user.language_code
-        else:
-            self.language = kwargs['language']
 
     def __str__(self):
         """Describe the user in the best way possible given the available data."""
@@ -88,8 +107,7 @@ class User(TableDeclarativeBase):
 
     @property
     def referrals(self):
-        joined_referred_users = [u for u in self.referred_users if u.joined]
-        return len(joined_referred_users)
+        return self.joined_referrals_count
 
     @property
     def balance(self):
@@ -115,3 +133,142 @@ class Admin(TableDeclarativeBase):
 
     def __repr__(self):
         return f"<Admin {self.user_id}>"
+
+
+class BroadcastJob(TableDeclarativeBase):
+    """A message being copied to every user, persisted so that it can be resumed after a restart."""
+
+    job_id = Column(Integer, primary_key=True)
+    # The message to copy
+    from_chat_id = Column(BigInteger, nullable=False)
+    message_id = Column(BigInteger, nullable=False)
+    # The message reporting the progress to the admin who started the broadcast
+    admin_chat_id = Column(BigInteger, nullable=False)
+    status_message_id = Column(BigInteger)
+
+    # The filters selecting the recipients, as json, see broadcast.Segment
+    segment = Column(String)
+
+    # running or completed
+    status = Column(String, nullable=False, default="running")
+    # The highest user id reached, every recipient up to it has an outcome stored
+    cursor = Column(BigInteger)
+    total = Column(Integer)
+    sent = Column(Integer, nullable=False, default=0)
+    blocked = Column(Integer, nullable=False, default=0)
+    failed = Column(Integer, nullable=False, default=0)
+
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    # Extra table parameters
+    __tablename__ = "broadcast_jobs"
+
+    def __repr__(self):
+        return f"<BroadcastJob {self.job_id} {self.status}>"
+
+
+class BroadcastRecipient(TableDeclarativeBase):
+    """The outcome of a broadcast for a single user."""
+
+    job_id = Column(Integer, ForeignKey("broadcast_jobs.job_id"), primary_key=True)
+    user_id = Column(BigInteger, primary_key=True)
+    # pending while being sent, then sent, blocked or failed
+    # pending recipients found after a restart become unknown and are never sent again
+    outcome = Column(String, nullable=False, default="pending")
+
+    # Extra table parameters
+    __tablename__ = "broadcast_recipients"
+
+    def __repr__(self):
+        return f"<BroadcastRecipient {self.job_id}:{self.user_id} {self.outcome}>"
+
+
+class Payout(TableDeclarativeBase):
+    """A withdrawal of the balance of a user, sent in the background by payouts.PayoutQueue."""
+
+    payout_id = Column(Integer, primary_key=True)
+    user_id = Column(BigInteger, ForeignKey("users.user_id"), nullable=False)
+    # user id and claimed amount the withdrawal started from, a second withdrawal of the same balance is refused
+    idempotency_key = Column(String, nullable=False, unique=True)
+    wallet = Column(String, nullable=False)
+    amount = Column(Float, nullable=False)
+
+    # queued until a worker picks it up, sending while in flight, then sent or failed
+    # sent payouts become confirmed, or queued again when their transaction is dropped
+    # payouts found sending after a restart are sent when they have a signature, or queued again without one
+    status = Column(String, nullable=False, default="queued")
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt_at = Column(DateTime, default=datetime.utcnow)
+    last_error = Column(String)
+    # The transaction carrying the transfer, it expires with its blockhash
+    signature = Column(String)
+    blockhash = Column(String)
+    tx_url = Column(String)
+
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    # Extra table parameters
+    __tablename__ = "payouts"
+    __table_args__ = (
+        Index("ix_payouts_status_next_attempt_at", "status", "next_attempt_at"),
+    )
+
+    def __repr__(self):
+        return f"<Payout {self.payout_id} of {self.user_id} {self.status}>"
+
+
+def add_missing_columns(connection, table) -> list:
+    """Add to an existing table the columns that were introduced after it was created.
+    Returns the names of the added columns."""
+    existing = {column["name"] for column in sqlalchemy.inspect(connection).get_columns(table.name)}
+    added = []
+    for column in table.columns:
+        if column.name in existing:
+            continue
+        log.info(f"Adding missing column {table.name}.{column.name}")
+        ddl = f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(connection.dialect)}"
+        if column.server_default is not None:
+            ddl += f" DEFAULT {column.server_default.arg}"
+        if not column.nullable:
+            ddl += " NOT NULL"
+        connection.execute(text(ddl))
+        added.append(column.name)
+    return added
+
+
+def add_missing_indexes(connection, table) -> list:
+    """Create the indexes of a table that were introduced after it was created.
+    Returns the names of the created indexes."""
+    existing = {index["name"] for index in sqlalchemy.inspect(connection).get_indexes(table.name)}
+    added = []
+    for index in table.indexes:
+        if index.name in existing:
+            continue
+        log.info(f"Creating missing index {index.name}")
+        index.create(connection)
+        added.append(index.name)
+    return added
+
+
+def backfill_referral_counts(connection):
+    """Recompute the denormalized referral counters of every user from the referred users."""
+    users = User.__table__
+    referred = users.alias("referred")
+    total = select(func.count()).where(referred.c.referred_by_id == users.c.user_id).scalar_subquery()
+    joined = select(func.count()).where(referred.c.referred_by_id == users.c.user_id,
+                                        referred.c.joined.is_(True)).scalar_subquery()
+    connection.execute(update(users).values(total_referrals_count=total, joined_referrals_count=joined))
+
+
+def upgrade(connection):
+    """Bring a database created by an older version of the bot up to date.
+    Meant to be run through :meth:`AsyncConnection.run_sync`."""
+    added = []
+    for table in TableDeclarativeBase.metadata.sorted_tables:
+        added += add_missing_columns(connection, table)
+        add_missing_indexes(connection, table)
+    if "joined_referrals_count" in added or "total_referrals_count" in added:
+        log.info("Backfilling the referral counters")
+        backfill_referral_counts(connection)
@@ -0,0 +1,119 @@
+import asyncio
+import csv
+import gzip
+import io
+import logging
+import tempfile
+import zipfile
+
+from sqlalchemy import select
+
+from database import User
+
+log = logging.getLogger(__name__)
+
+# The columns that can be exported: key -> (header, value of a row)
+COLUMNS = {
+    "id": ("User Id", lambda row: row.user_id),
+    "name": ("Name", lambda row: f"{row.first_name} {row.last_name}" if row.last_name else row.first_name),
+    "username": ("Username", lambda row: row.username),
+    "wallet": ("Wallet Address", lambda row: row.wallet),
+    "reward": ("Reward Amount", lambda row: row.reward),
+    "claimed": ("Claimed Amount", lambda row: row.claimed),
+    "balance": ("Balance Amount", lambda row: round(row.reward - row.claimed, 4)),
+}
+
+DEFAULT_COLUMNS = ["id", "name", "wallet", "reward", "claimed", "balance"]
+
+FORMATS = ("csv", "gzip", "zip")
+
+# Characters of CSV collected in memory before they are compressed and written out in a worker thread
+CHUNK_SIZE = 256 * 1024
+
+# Only the plain columns the exported values are computed from are read, never full ORM objects
+SOURCE = select(User.user_id, User.first_name, User.last_name, User.username,
+                User.wallet, User.reward, User.claimed)
+
+
+class ExportError(Exception):
+    def __init__(self, message="Invalid export request"):
+        self.message = message
+        super().__init__(self.message)
+
+
+def parse_columns(text: str) -> list:
+    columns = [column.strip() for column in text.split(",") if column.strip()]
+    unknown = [column for column in columns if column not in COLUMNS]
+    if unknown:
+        raise ExportError(f"Unknown columns: {', '.join(unknown)}\nAvailable columns: {', '.join(COLUMNS)}")
+    return columns
+
+
+async def iter_rows(session_factory, batch_size: int):
+    """Yield the rows of the users table in primary key order, reading batch_size rows per query."""
+    last_id = None
+    while True:
+        statement = SOURCE.order_by(User.user_id).limit(batch_size)
+        if last_id is not None:
+            statement = statement.where(User.user_id > last_id)
+        async with session_factory() as session:
+            result = await session.execute(statement)
+            rows = result.all()
+        if not rows:
+            return
+        for row in rows:
+            yield row
+        last_id = rows[-1].user_id
+
+
+async def export_users(session_factory, *, fmt="csv", columns=None, batch_size=1000, spool_size=10 * 1024 * 1024):
+    """Write the users to a temporary file, which is kept in memory up to spool_size bytes and spilled to disk
+    after that. Returns the file, rewound, and the name it should be sent with.
+    Writing takes constant memory, but uploading the file loads it whole, see download in main.py."""
+    if fmt not in FORMATS:
+        raise ExportError(f"Unknown format {fmt}\nAvailable formats: {', '.join(FORMATS)}")
+    columns = columns or DEFAULT_COLUMNS
+
+    output = tempfile.SpooledTemporaryFile(max_size=spool_size)
+    if fmt == "gzip":
+        filename = "user_data.csv.gz"
+        container = gzip.GzipFile(filename="user_data.csv", fileobj=output, mode="wb")
+        stream = container
+    elif fmt == "zip":
+        filename = "user_data.zip"
+        container = zipfile.ZipFile(output, mode="w", compression=zipfile.ZIP_DEFLATED)
+        stream = container.open("user_data.csv", mode="w", force_zip64=True)
+    else:
+        filename = "user_data.csv"
+        container = None
+        stream = output
+
+    # Compression is CPU bound and the temporary file may be on disk, so neither happens on the event loop
+    text = io.StringIO(newline="")
+    csv_writer = csv.writer(text)
+
+    async def write_chunk():
+        chunk = text.getvalue().encode("utf-8")
+        text.seek(0)
+        text.truncate()
+        await asyncio.to_thread(stream.write, chunk)
+
+    def finish():
+        # Flush everything down to the temporary file without closing it
+        if fmt == "zip":
+            stream.close()
+        if container is not None:
+            container.close()
+        output.seek(0)
+
+    csv_writer.writerow([COLUMNS[column][0] for column in columns])
+    count = 0
+    async for row in iter_rows(session_factory, batch_size):
+        csv_writer.writerow([COLUMNS[column][1](row) for column in columns])
+        count += 1
+        if text.tell() >= CHUNK_SIZE:
+            await write_chunk()
+    await write_chunk()
+    await asyncio.to_thread(finish)
+    log.debug(f"Exported {count} users to {filename}")
+    return output, filename
@@ -0,0 +1,121 @@
+import datetime
+import logging
+from collections import namedtuple
+
+from sortedcontainers import SortedList
+from sqlalchemy import select
+
+from database import User
+
+log = logging.getLogger(__name__)
+
+# A row of the leaderboard, shaped like the rows of the former GROUP BY query
+Referral = namedtuple("Referral", ["referred_by_id", "referral_count"])
+
+
+class RankIndex:
+    """The number of joined referrals of each referrer, kept sorted by count."""
+
+    def __init__(self):
+        self.counts = {}
+        # (-count, referrer_id), so that the best referrers come first
+        self.ranking = SortedList()
+
+    def add(self, referrer_id, amount=1):
+        count = self.counts.get(referrer_id, 0)
+        if count:
+            self.ranking.remove((-count, referrer_id))
+        self.counts[referrer_id] = count + amount
+        self.ranking.add((-count - amount, referrer_id))
+
+    def top(self, limit: int) -> list:
+        return [Referral(referrer_id, -count) for count, referrer_id in self.ranking.islice(0, limit)]
+
+    def __eq__(self, other):
+        return isinstance(other, RankIndex) and self.counts == other.counts
+
+
+def day_start(moment: datetime.datetime) -> datetime.date:
+    return moment.date()
+
+
+def week_start(moment: datetime.datetime) -> datetime.date:
+    return (moment - datetime.timedelta(days=moment.weekday())).date()
+
+
+class Leaderboard:
+    """In-memory referral leaderboard, built once at startup and updated on every join.
+
+    Referrals are bucketed by the creation date of the referred user, like the SQL query it replaces; only the
+    buckets of the current day and week are kept besides the all time index."""
+
+    def __init__(self, session_factory):
+        self.session_factory = session_factory
+        self.all = RankIndex()
+        self.daily = {}
+        self.weekly = {}
+        # number of referrals added, to detect the ones counted while the database was being read
+        self.added = 0
+
+    def add(self, referrer_id, created_at: datetime.datetime):
+        """Count a new joined referral."""
+        self.added += 1
+        self.all.add(referrer_id)
+        self._prune()
+        now = datetime.datetime.utcnow()
+        if day_start(created_at) == day_start(now):
+            self.daily.setdefault(day_start(created_at), RankIndex()).add(referrer_id)
+        if week_start(created_at) == week_start(now):
+            self.weekly.setdefault(week_start(created_at), RankIndex()).add(referrer_id)
+
+    def _prune(self):
+        """Drop the buckets of the past days and weeks."""
+        now = datetime.datetime.utcnow()
+        for buckets, start in ((self.daily, day_start(now)), (self.weekly, week_start(now))):
+            for key in [key for key in buckets if key != start]:
+                del buckets[key]
+
+    def top(self, period: str, limit: int) -> list:
+        self._prune()
+        now = datetime.datetime.utcnow()
+        if period == 'daily':
+            index = self.daily.get(day_start(now))
+        elif period == 'weekly':
+            index = self.weekly.get(week_start(now))
+        elif period == 'all':
+            index = self.all
+        else:
+            raise ValueError("Invalid period. Supported periods: 'daily', 'weekly', 'all'")
+        return index.top(limit) if index is not None else []
+
+    async def _load(self):
+        """Build a new leaderboard from the database."""
+        leaderboard = Leaderboard(self.session_factory)
+        async with self.session_factory() as session:
+            result = await session.stream(
+                select(User.referred_by_id, User.created_at)
+                .where(User.joined == True, User.referred_by_id.isnot(None))
+            )
+            async for referrer_id, created_at in result:
+                leaderboard.add(referrer_id, created_at or datetime.datetime.min)
+        return leaderboard
+
+    def _swap(self, other: "Leaderboard"):
+        self.all, self.daily, self.weekly = other.all, other.daily, other.weekly
+
+    async def build(self):
+        self._swap(await self._load())
+        log.debug(f"Built the leaderboard of {len(self.all.counts)} referrers")
+
+    async def check(self):
+        """Compare the leaderboard with the database, replacing it if they drifted apart."""
+        added = self.added
+        loaded = await self._load()
+        if self.added != added:
+            log.debug("Referrals joined while checking the leaderboard, skipping this check")
+            return
+        loaded._prune()
+        self._prune()
+        if loaded.all != self.all or loaded.daily != self.daily or loaded.weekly != self.weekly:
+            log.warning("The leaderboard drifted from the database, replacing it")
+            self._swap(loaded)
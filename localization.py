@@ -1,9 +1,14 @@
 import importlib
+import importlib.util
 import json
 import logging
+import re
+import string
 import types
 from typing import *
 
+from cachetools import LRUCache
+
 log = logging.getLogger(__name__)
 
 
@@ -15,13 +20,18 @@ class IgnoreDict(dict):
 
 
 class Localization:
+    """The strings of a language, loaded once into a flat table.
+
+    The replacement fields of every string are parsed when the table is built: strings without any are stored
+    already formatted and returned as they are, the others are formatted only with the values they use."""
+
     def __init__(self, language: str, *, fallback: str, replacements: Dict[str, str] = None):
-        log.debug(f"Creating localization for {language}")
+        log.debug("Creating localization for %s", language)
         self.language: str = language
-        log.debug(f"Importing strings.{language}")
+        log.debug("Importing strings.%s", language)
         self.module: types.ModuleType = importlib.import_module(f"strings.{language}")
         if language != fallback:
-            log.debug(f"Importing strings.{fallback} as fallback")
+            log.debug("Importing strings.%s as fallback", fallback)
             self.fallback_language: str = fallback
             self.fallback_module = importlib.import_module(f"strings.{fallback}") if fallback else None
         else:
@@ -29,25 +39,99 @@ class Localization:
             self.fallback_language = None
             self.fallback_module = None
         self.replacements: Dict[str, str] = replacements if replacements else {}
+        # key -> (string, names of its replacement fields)
+        self.strings: Dict[str, Tuple[str, FrozenSet[str]]] = {}
+        self._load()
+
+    @staticmethod
+    def _module_strings(module: types.ModuleType) -> Dict[str, str]:
+        return {key: value for key, value in vars(module).items()
+                if isinstance(value, str) and not (key.startswith("__") and key.endswith("__"))}
+
+    def _load(self):
+        strings = self._module_strings(self.module)
+        if self.fallback_module:
+            fallback_strings = self._module_strings(self.fallback_module)
+            missing = fallback_strings.keys() - strings.keys()
+            if missing:
+                log.warning("%d localized strings missing in %s, using default", len(missing), self.language)
+                log.debug("Missing localized strings in %s: %s", self.language, ", ".join(sorted(missing)))
+            strings = {**fallback_strings, **strings}
+        for key, text in strings.items():
+            fields = frozenset(re.split(r"[.\[]", field)[0]
+                               for _, field, _, _ in string.Formatter().parse(text) if field is not None)
+            if not fields:
+                # Formatting would only turn the escaped {{ and }} into braces, do it once now
+                text = text.format()
+            self.strings[key] = (text, fields)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.strings
 
     def get(self, key: str, **kwargs) -> str:
         try:
-            log.debug(f"Getting localized string with key {key}")
-            string = self.module.__getattribute__(key)
-        except AttributeError:
-            if self.fallback_module:
-                log.warning(f"Missing localized string with key {key}, using default")
-                string = self.fallback_module.__getattribute__(key)
-            else:
-                raise
-        assert isinstance(string, str)
-        formatter = IgnoreDict(**self.replacements, **kwargs)
-        return string.format_map(formatter)
+            string, fields = self.strings[key]
+        except KeyError:
+            raise AttributeError(f"Missing localized string with key {key}") from None
+        if not fields:
+            return string
+        values = {**self.replacements, **kwargs} if self.replacements else kwargs
+        if fields <= values.keys():
+            return string.format_map(values)
+        return string.format_map(IgnoreDict(values))
 
     def boolmoji(self, boolean: bool) -> str:
         return self.get("emoji_yes") if boolean else self.get("emoji_no")
 
 
+def normalize_language(code: Optional[str]) -> Optional[str]:
+    """Turn a language code as sent by Telegram, like pt-BR, into the name of its strings module, like pt_br."""
+    return code.strip().lower().replace("-", "_") if code else None
+
+
+class LocalizationRegistry:
+    """The localizations of the enabled languages, created on first use.
+
+    The most recently used ones are kept in a bounded LRU; the default language is always kept. Language modules
+    are imported once, and the fallback module is shared by every localization through the import system."""
+
+    def __init__(self, enabled: List[str], *, default: str, fallback: str, replacements: Dict[str, str] = None,
+                 maxsize: int = 8):
+        self.enabled: Set[str] = {normalize_language(language) for language in enabled}
+        self.fallback: str = fallback
+        self.replacements: Dict[str, str] = replacements if replacements else {}
+        self.default: Localization = Localization(default, fallback=fallback, replacements=self.replacements)
+        self.localizations: LRUCache = LRUCache(maxsize=maxsize)
+        # requested code -> language actually used, so that unknown codes are resolved only once
+        self.resolved: Dict[Optional[str], str] = {}
+
+    def resolve(self, code: Optional[str]) -> str:
+        """Return the enabled language to use for a language code, the default one if there is none."""
+        try:
+            return self.resolved[code]
+        except KeyError:
+            pass
+        language = normalize_language(code)
+        candidates = [language, language.split("_")[0]] if language else []
+        for candidate in candidates:
+            if candidate in self.enabled and importlib.util.find_spec(f"strings.{candidate}") is not None:
+                break
+        else:
+            candidate = self.default.language
+        self.resolved[code] = candidate
+        return candidate
+
+    def get(self, code: Optional[str]) -> Localization:
+        language = self.resolve(code)
+        if language == self.default.language:
+            return self.default
+        localization = self.localizations.get(language)
+        if localization is None:
+            localization = Localization(language, fallback=self.fallback, replacements=self.replacements)
+            self.localizations[language] = localization
+        return localization
+
+
 def create_json_localization_file_from_strings(language: str):
     module: types.ModuleType = importlib.import_module(f"strings.{language}")
     raw = module.__dict__
@@ -1,17 +1,9 @@
 import asyncio
-import csv
 import datetime
 import logging
 import os
-import random
-from functools import wraps
-from io import StringIO
-
-import sqlalchemy
-import sqlalchemy.ext.declarative as sed
-from captcha.image import ImageCaptcha
-from sqlalchemy import func
-from sqlalchemy.orm import joinedload
+from functools import lru_cache, partial, wraps
+
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardRemove
 from telegram.ext import (
     Application,
@@ -19,17 +11,30 @@ from telegram.ext import (
     ContextTypes,
     ConversationHandler,
     ChatJoinRequestHandler,
+    ChatMemberHandler,
     MessageHandler,
     filters, CallbackQueryHandler,
 )
 
+import configloader
 import database as db
+import export
 import localization
-import nuconfig
+import payments.rpc
+import payments.solana
 import payments.wallet
+from admins import AdminRoster
+from broadcast import Broadcaster, BroadcastJobs, Segment, SegmentError
 from cache import Cache
-from payments.solana import SolanaWallet
-from utils import AdminCommands, Vars
+from captcha_pool import CaptchaPool
+from leaderboard import Leaderboard
+from membership import MembershipCache
+from payments.batcher import PayoutBatcher
+from payments.solana import SolanaAsyncWallet
+from payouts import PayoutQueue, PayoutConflictError, ConfirmationTracker
+from session import Session, create_engine
+from stats import Stats
+from utils import AdminCommands, Vars, run_periodically
 
 # Enable logging
 logging.basicConfig(
@@ -46,37 +51,11 @@ COLLECTING_WALLET, LEADER_BOARD, VERIFY_SUM, BROADCAST = range(4)
 logging.root.setLevel("INFO")
 logger.debug("Set logging level to INFO while the config is being loaded")
 
-# Ensure the template config file exists
-if not os.path.isfile("config/template_config.toml"):
-    logger.fatal("config/template_config.toml does not exist!")
-    exit(254)
-
 # Check where the config path is located from the CONFIG_PATH environment variable
 config_path = os.environ.get("CONFIG_PATH", "config/config.toml")
 
-# If the config file does not exist, clone the template and exit
-if not os.path.isfile(config_path):
-    logger.debug("config/config.toml does not exist.")
-
-    with open("config/template_config.toml", encoding="utf8") as template_cfg_file, \
-            open(config_path, "w", encoding="utf8") as user_cfg_file:
-        # Copy the template file to the config file
-        user_cfg_file.write(template_cfg_file.read())
-
-    logger.fatal("A config file has been created."
-                 " Customize it, then restart greed!")
-    exit(1)
-
-# Compare the template config with the user-made one
-with open("config/template_config.toml", encoding="utf8") as template_cfg_file, \
-        open(config_path, encoding="utf8") as user_cfg_file:
-    template_cfg = nuconfig.NuConfig(template_cfg_file)
-    user_cfg = nuconfig.NuConfig(user_cfg_file)
-    if not template_cfg.cmplog(user_cfg):
-        logger.fatal("There were errors while parsing the config file. Please fix them and restart greed!")
-        exit(2)
-    else:
-        logger.debug("Configuration parsed successfully!")
+# Parse and validate the config file, user_cfg always reads the latest valid version of it
+user_cfg = configloader.load_config(config_path)
 
 # Finish logging setup
 logging.root.setLevel(user_cfg["Logging"]["level"])
@@ -95,38 +74,81 @@ else:
 
 # Create the database engine
 logger.debug("Creating the sqlalchemy engine...")
-engine = sqlalchemy.create_engine(db_engine)
-logger.debug("Binding metadata to the engine...")
-db.TableDeclarativeBase.metadata.bind = engine
-logger.debug("Creating all missing tables...")
-db.TableDeclarativeBase.metadata.create_all()
-logger.debug("Preparing the tables through deferred reflection...")
-sed.DeferredReflection.prepare(engine)
-
-# Finding default language
-default_language = user_cfg["Language"]["default_language"]
-
-# Create a new Localization object
-loc = localization.Localization(
-    language=default_language,
-    fallback=user_cfg["Language"]["fallback_language"],
-    replacements={
-        # "user_string": str(user),
-        # "user_mention": user.mention(),
-        # "user_full_name": user.full_name,
-        # "user_first_name": user.first_name,
-        "today": datetime.datetime.now().strftime("%a %d %b %Y"),
-    }
-)
+engine = create_engine(db_engine,
+                       pool_size=user_cfg["Database"]["pool_size"],
+                       max_overflow=user_cfg["Database"]["max_overflow"],
+                       pool_pre_ping=user_cfg["Database"]["pool_pre_ping"],
+                       pool_recycle=user_cfg["Database"]["pool_recycle"],
+                       busy_timeout=user_cfg["Database"]["busy_timeout"])
+Session.configure(bind=engine)
+
+
+def create_localizations():
+    return localization.LocalizationRegistry(
+        user_cfg["Language"]["enabled_languages"],
+        default=user_cfg["Language"]["default_language"],
+        fallback=user_cfg["Language"]["fallback_language"],
+        replacements={
+            # "user_string": str(user),
+            # "user_mention": user.mention(),
+            # "user_full_name": user.full_name,
+            # "user_first_name": user.first_name,
+            "today": datetime.datetime.now().strftime("%a %d %b %Y"),
+        },
+        maxsize=user_cfg["Language"]["localization_cache_size"],
+    )
+
+
+# Create the localizations of the enabled languages, loc is the one of the default language
+localizations = create_localizations()
+loc = localizations.default
 
 # create cache class for users
-cache = Cache(engine)
+cache = Cache(Session,
+              policy=user_cfg["Cache"]["policy"],
+              maxsize=user_cfg["Cache"]["maxsize"],
+              ttl=user_cfg["Cache"]["ttl"])
+admins = AdminRoster(Session)
+leaderboard = Leaderboard(Session)
+stats = Stats(Session)
+captchas = CaptchaPool(size=user_cfg["Captcha"]["pool_size"],
+                       workers=user_cfg["Captcha"]["workers"],
+                       spill_dir=user_cfg["Captcha"]["spill_dir"],
+                       spill_size=user_cfg["Captcha"]["spill_size"])
+broadcaster = Broadcaster(rate=user_cfg["Broadcast"]["rate"],
+                          concurrency=user_cfg["Broadcast"]["concurrency"],
+                          max_retries=user_cfg["Broadcast"]["max_retries"])
+broadcast_jobs = BroadcastJobs(Session, broadcaster, cache=cache,
+                               batch_size=user_cfg["Broadcast"]["batch_size"],
+                               progress_interval=user_cfg["Broadcast"]["progress_interval"])
+membership = MembershipCache(maxsize=user_cfg["Cache"]["maxsize"], ttl=user_cfg["Cache"]["membership_ttl"])
 variables = Vars()
 admin_commands = AdminCommands()
-solana_wallet = SolanaWallet(payments.solana.ENDPOINT)
-
-
-def create_start_menu():
+solana_wallet = SolanaAsyncWallet(user_cfg["Payments"]["rpc_endpoints"],
+                                  timeout=user_cfg["Payments"]["rpc_timeout"],
+                                  max_connections=user_cfg["Payments"]["rpc_max_connections"],
+                                  failure_threshold=user_cfg["Payments"]["rpc_failure_threshold"],
+                                  cooldown=user_cfg["Payments"]["rpc_cooldown"],
+                                  balance_ttl=user_cfg["Payments"]["balance_ttl"])
+payout_batcher = PayoutBatcher(solana_wallet,
+                               window=user_cfg["Payments"]["batch_window"],
+                               max_transfers=user_cfg["Payments"]["batch_max_transfers"])
+payout_queue = PayoutQueue(Session, payout_batcher,
+                           workers=user_cfg["Payments"]["workers"],
+                           max_attempts=user_cfg["Payments"]["max_attempts"],
+                           retry_delay=user_cfg["Payments"]["retry_delay"],
+                           poll_interval=user_cfg["Payments"]["poll_interval"])
+confirmation_tracker = ConfirmationTracker(Session, solana_wallet, payout_queue,
+                                           commitment=user_cfg["Payments"]["confirmation_commitment"])
+
+
+def create_start_menu(loc):
+    return _create_start_menu(loc, variables.version)
+
+
+# Markups only change with the language and the variables, they are built once per localization and version
+@lru_cache(maxsize=64)
+def _create_start_menu(loc, version):
     user_menu_kb = [
         [
             InlineKeyboardButton(loc.get("menu_referral_link"), callback_data="1"),
@@ -151,32 +173,75 @@ def create_start_menu():
     return InlineKeyboardMarkup(user_menu_kb)
 
 
-cancel_kb = [[
-    InlineKeyboardButton(loc.get("menu_cancel"), callback_data="cancel"),
-]]
+@lru_cache(maxsize=16)
+def create_cancel_menu(loc):
+    cancel_kb = [[
+        InlineKeyboardButton(loc.get("menu_cancel"), callback_data="cancel"),
+    ]]
+
+    return InlineKeyboardMarkup(cancel_kb)
+
+
+@lru_cache(maxsize=16)
+def create_leaderboard_menu(loc):
+    leaderboard_menu_kb = [
+        [
+            InlineKeyboardButton(loc.get("lb_menu_daily"), callback_data="daily"),
+            InlineKeyboardButton(loc.get("lb_menu_weekly"), callback_data="weekly"),
+        ],
+        [
+            InlineKeyboardButton(loc.get("lb_menu_top3"), callback_data="top3"),
+            InlineKeyboardButton(loc.get("lb_menu_top5"), callback_data="top5"),
+        ],
+        [
+            InlineKeyboardButton(loc.get("lb_menu_top10"), callback_data="top10"),
+            InlineKeyboardButton(loc.get("lb_menu_top20"), callback_data="top20"),
+        ],
+        [
+            InlineKeyboardButton(loc.get("menu_cancel"), callback_data="cancel")
+        ],
+
+    ]
+
+    return InlineKeyboardMarkup(leaderboard_menu_kb)
+
+
+# Settings read when the bot starts, changing them needs a restart; the others are read when they are used
+RESTART_KEYS = {
+    "Telegram": ["token"],
+    "Database": ["engine", "pool_size", "max_overflow", "pool_pre_ping", "pool_recycle", "busy_timeout"],
+    "Cache": ["policy", "maxsize", "ttl", "membership_ttl", "admin_refresh_interval", "leaderboard_check_interval",
+              "stats_refresh_interval", "config_reload_interval"],
+    "Payments": ["rpc_endpoints", "rpc_timeout", "rpc_max_connections", "rpc_failure_threshold", "rpc_cooldown",
+                 "balance_ttl", "batch_window", "batch_max_transfers", "workers", "max_attempts", "retry_delay",
+                 "poll_interval", "confirmation_interval", "confirmation_commitment"],
+    "Broadcast": ["rate", "concurrency", "max_retries", "progress_interval", "batch_size"],
+    "Captcha": ["pool_size", "workers", "spill_dir", "spill_size"],
+}
 
-cancel_rm = InlineKeyboardMarkup(cancel_kb)
 
-leaderboard_menu_kb = [
-    [
-        InlineKeyboardButton(loc.get("lb_menu_daily"), callback_data="daily"),
-        InlineKeyboardButton(loc.get("lb_menu_weekly"), callback_data="weekly"),
-    ],
-    [
-        InlineKeyboardButton(loc.get("lb_menu_top3"), callback_data="top3"),
-        InlineKeyboardButton(loc.get("lb_menu_top5"), callback_data="top5"),
-    ],
-    [
-        InlineKeyboardButton(loc.get("lb_menu_top10"), callback_data="top10"),
-        InlineKeyboardButton(loc.get("lb_menu_top20"), callback_data="top20"),
-    ],
-    [
-        InlineKeyboardButton(loc.get("menu_cancel"), callback_data="cancel")
-    ],
+def reload_config(old, new):
+    """Rebuild what depends on the config file once a new version of it is loaded"""
+    global localizations, loc
+    logging.root.setLevel(new["Logging"]["level"])
+    if new["Language"] != old["Language"]:
+        logger.info("Reloading the localizations")
+        localizations = create_localizations()
+        loc = localizations.default
+    # the markups hold localized strings and depend on the Telegram settings
+    _create_start_menu.cache_clear()
+    create_cancel_menu.cache_clear()
+    create_leaderboard_menu.cache_clear()
+    for section, keys in RESTART_KEYS.items():
+        for key in keys:
+            if new[section][key] != old[section][key]:
+                logger.warning(f"{section}.{key} is only read at startup, it will change after a restart")
 
-]
 
-leaderboard_rm = InlineKeyboardMarkup(leaderboard_menu_kb)
+user_cfg.subscribe(reload_config)
+
+# tasks running in the background while the bot is up, cancelled on shutdown
+background_tasks = []
 
 
 async def private(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -190,9 +255,17 @@ async def private(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return False
 
 
+async def get_localization(update: Update):
+    """The localization to answer with: the language of the user in private chats, the default one in groups"""
+    if update.effective_chat is not None and update.effective_chat.type != 'private':
+        return loc
+    user = await cache.get_user(update.effective_user.id)
+    return localizations.get(user.language if user else None)
+
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Sends a message with menu inline buttons attached."""
-    user = cache.get_user(update.effective_user.id)
+    user = await cache.get_user(update.effective_user.id)
 
     if not user:
         referred_by_id = None
@@ -209,19 +282,19 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
                 referred_by_id = None
 
         logger.debug(f"Creating user {update.effective_user.id}")
-        session = sqlalchemy.orm.sessionmaker(bind=engine)()
-        user = db.User(update.effective_user,
-                       referred_by_id=referred_by_id,
-                       language=user_cfg["Language"]["default_language"])
-        session.add(user)
-        session.commit()
-        # Query the user from the database to get the refreshed user
-        user = session.query(db.User).filter_by(user_id=update.effective_user.id).first()
-        session.close()
+        user = await cache.create_user(update.effective_user,
+                                 referred_by_id=referred_by_id,
+                                 language=localizations.resolve(update.effective_user.language_code))
+        stats.user_created(referred=referred_by_id is not None)
+
+    if user.bot_blocked:
+        # the user unblocked the bot, broadcasts reach it again
+        await cache.update_user(user.user_id, {'bot_blocked': False})
 
     if not user.verified:
         return await start_verification(update, context)
 
+    loc = localizations.get(user.language)
     await update.message.reply_text(loc.get('conversation_after_start'), reply_markup=ReplyKeyboardRemove())
 
     if user.referred_by_id and not user.joined:
@@ -231,7 +304,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
             return
 
     await update.message.reply_text(text=loc.get("conversation_open_user_menu"),
-                                    reply_markup=create_start_menu(),
+                                    reply_markup=create_start_menu(loc),
                                     parse_mode='HTML')
 
 
@@ -239,7 +312,11 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Parses the CallbackQuery and updates the message text."""
     query = update.callback_query
     show_alert = False
-    user = cache.get_user(update.effective_user.id)
+    user = await cache.get_user(update.effective_user.id)
+    loc = localizations.get(user.language)
+
+    if user.bot_blocked:
+        await cache.update_user(user.user_id, {'bot_blocked': False})
 
     if not await is_user_member(context.bot, user_cfg['Telegram']['group_id'], user.user_id):
         if user.referred_by:
@@ -265,9 +342,9 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
                 name=user.user_id,
                 creates_join_request=True)
             user.referral_link = chat_invite_link.invite_link
-            cache.update_user(update.effective_user.id, {'referral_link': user.referral_link})
-        me = await context.bot.getMe()
-        bot_referral_link = f"https://t.me/{me.username}?start={user.user_id}"
+            await cache.update_user(update.effective_user.id, {'referral_link': user.referral_link})
+        # the identity of the bot is fetched once when the application starts
+        bot_referral_link = f"https://t.me/{context.bot.username}?start={user.user_id}"
         text = f"Here is your referral link \n\n{bot_referral_link}"
 
     elif query.data == '2':
@@ -280,7 +357,7 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         notification = "Getting leader board"
         text = "Leader Board"
         await query.answer(notification, show_alert=show_alert)
-        await query.message.reply_text(text=text, reply_markup=leaderboard_rm, parse_mode='HTML')
+        await query.message.reply_text(text=text, reply_markup=create_leaderboard_menu(loc), parse_mode='HTML')
         await query.delete_message()
         return
         # return LEADER_BOARD
@@ -304,7 +381,7 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         else:
             text = f"Please enter your SOLANA wallet address"
         await query.answer()
-        await query.message.reply_text(text=text, reply_markup=cancel_rm, parse_mode='HTML')
+        await query.message.reply_text(text=text, reply_markup=create_cancel_menu(loc), parse_mode='HTML')
         await query.delete_message()
         return COLLECTING_WALLET
 
@@ -321,12 +398,13 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         return await leader_board(update, context)
 
     await query.answer(notification, show_alert=show_alert)
-    await query.message.reply_text(text=text, reply_markup=create_start_menu(), parse_mode='HTML')
+    await query.message.reply_text(text=text, reply_markup=create_start_menu(loc), parse_mode='HTML')
     await query.delete_message()
 
 
 async def leader_board(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
+    loc = await get_localization(update)
     if query.data == 'daily':
         period = 'daily'
         limit = 5
@@ -349,34 +427,44 @@ async def leader_board(update: Update, context: ContextTypes.DEFAULT_TYPE):
         notification = "Cancelling operation"
         text = loc.get("conversation_open_user_menu")
         await query.answer(notification)
-        await query.message.reply_text(text=text, reply_markup=create_start_menu(), parse_mode='HTML')
+        await query.message.reply_text(text=text, reply_markup=create_start_menu(loc), parse_mode='HTML')
         await query.delete_message()
         return ConversationHandler.END
     else:
         return ConversationHandler.END
 
     top_referrals = get_top_referrals(period, limit)
+    users = await cache.get_users([referral[0] for referral in top_referrals])
     text = f"<b>{loc.get(f'lb_menu_{query.data}')}</b>\n\n"
     for i, referral in enumerate(top_referrals):
-        user = cache.get_user(referral[0])
+        user = users.get(referral[0])
+        if user is None:
+            continue
         text += f"<code>{i + 1}. {user.full_name:<15} - {referral.referral_count:2}</code>\n"
 
     await query.answer()
-    await query.message.reply_text(text=text, reply_markup=leaderboard_rm, parse_mode='HTML')
+    await query.message.reply_text(text=text, reply_markup=create_leaderboard_menu(loc), parse_mode='HTML')
     await query.delete_message()
 
 
 async def leader_board_detail(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    size = user_cfg["Appearance"]["leader_board_top"]
     top_users = {
         'daily': get_top_referrals('daily', 5),
         'weekly': get_top_referrals('weekly', 5),
-        'top20': get_top_referrals('all', 20)
+        f'top{size}': get_top_referrals('all', size)
     }
+    # load every user shown in the leaderboard with a single query
+    users = await cache.get_users([referral[0] for top in top_users.values() for referral in top])
+    loc = await get_localization(update)
     text = f"{loc.get('text_leaderboard')}\n\n"
     for key, top in top_users.items():
-        text += f"<b>{loc.get(f'lb_menu_{key}')}</b>\n\n"
+        title = loc.get(f'lb_menu_{key}') if f'lb_menu_{key}' in loc else loc.get('lb_menu_top_n', size=size)
+        text += f"<b>{title}</b>\n\n"
         for i, referral in enumerate(top):
-            user = cache.get_user(referral[0])
+            user = users.get(referral[0])
+            if user is None:
+                continue
             text += f"<code>{i + 1}. {user.full_name[:30]:<15} - {referral.referral_count:>2}</code>\n"
         text += "\n\n"
 
@@ -389,14 +477,20 @@ async def leader_board_detail(update: Update, context: ContextTypes.DEFAULT_TYPE
 
 
 async def withdraw(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user = cache.get_user(update.effective_user.id)
+    user = await cache.get_user(update.effective_user.id)
     query = update.callback_query
 
     if not variables.withdraw_enabled:
         await query.answer(f"Currently withdraw option is disabled.", True)
         return
 
-    if not solana_wallet.is_valid_address(user.wallet):
+    try:
+        wallet_valid = await check_wallet(user)
+    except payments.rpc.RPCError as e:
+        logger.error(f"Wallet check of {user.user_id} failed: {e.message}")
+        await query.answer("Payments are temporarily unavailable, please try again later.", True)
+        return
+    if not wallet_valid:
         await query.answer("Your wallet address is not valid.", True)
         return
 
@@ -413,28 +507,47 @@ async def withdraw(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     try:
-        solana_wallet.set_private_key(variables.private_key)
-        balance = user.balance
-        currency_symbol = user_cfg['Payments']['currency_symbol']
-        tx_url = solana_wallet.send(user.wallet, balance)
-        cache.update_user(user.user_id, {"claimed": user.reward})
-        await query.message.reply_text(f"Rewards of <b>{user.balance} {currency_symbol}</b> sent successfully.",
-                                       parse_mode='HTML')
-        await query.message.reply_text(tx_url)
-        await context.bot.send_message(chat_id=user_cfg['Telegram']['group_id'],
-                                       text=loc.get('text_withdraw_proof',
-                                                    username=user.mention(),
-                                                    balance=balance,
-                                                    currency_symbol=currency_symbol,
-                                                    tx_url=tx_url),
-                                       parse_mode='HTML',
-                                       )
+        solana_wallet.is_private_key_set()
+        payout = await payout_queue.enqueue(user)
     except payments.wallet.PrivateKeyNoneError:
         await query.answer("Admin has not yet configured the wallet to send rewards.", True)
-    except payments.wallet.InvalidAddressError:
-        await query.answer("Your wallet address is not valid.", True)
-    except payments.wallet.NotEnoughBalanceError:
-        await query.answer("Admin wallet doesnt have enough balance to pay.", True)
+        return
+    except PayoutConflictError:
+        await query.answer("Your withdrawal is already being processed.", True)
+        return
+    finally:
+        cache.invalidate(user.user_id)
+    stats.reward_claimed(payout.amount)
+    await query.answer()
+    await query.message.reply_text(f"Withdrawal of <b>{payout.amount} {user_cfg['Payments']['currency_symbol']}</b> "
+                                   f"queued, you will receive the transaction shortly.", parse_mode='HTML')
+
+
+async def report_payout(bot, payout):
+    """Tell the user how the payout ended, and prove the confirmed ones in the group"""
+    currency_symbol = user_cfg['Payments']['currency_symbol']
+    if payout.status == "confirmed":
+        user = await cache.get_user(payout.user_id)
+        await bot.send_message(chat_id=payout.user_id,
+                               text=f"Rewards of <b>{payout.amount} {currency_symbol}</b> sent successfully.",
+                               parse_mode='HTML')
+        await bot.send_message(chat_id=payout.user_id, text=payout.tx_url)
+        await bot.send_message(chat_id=user_cfg['Telegram']['group_id'],
+                               text=loc.get('text_withdraw_proof',
+                                            username=user.mention(),
+                                            balance=payout.amount,
+                                            currency_symbol=currency_symbol,
+                                            tx_url=payout.tx_url),
+                               parse_mode='HTML',
+                               )
+    elif payout.status == "failed":
+        # The amount went back to the balance of the user
+        cache.invalidate(payout.user_id)
+        stats.reward_claimed(-payout.amount)
+        await bot.send_message(chat_id=payout.user_id,
+                               text=f"Your withdrawal of <b>{payout.amount} {currency_symbol}</b> could not be sent, "
+                                    f"the amount was returned to your balance.",
+                               parse_mode='HTML')
 
 
 def admin_only(func):
@@ -443,8 +556,7 @@ def admin_only(func):
         user_id = update.message.from_user.id
 
         # Check if the user is an admin
-        chat_admins = await context.bot.get_chat_administrators(user_cfg['Telegram']['group_id']) or []
-        if any(admin.user.id == user_id for admin in chat_admins):
+        if await admins.check(context.bot, user_cfg['Telegram']['group_id'], user_id):
             return await func(update, context, *args, **kwargs)
         else:
             await update.message.reply_text("You are not authorized to use this command.")
@@ -456,8 +568,13 @@ def admin_only(func):
 async def admin_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = f"<b>Admin Help Menu</b>\n\n" \
            f"{admin_commands}\n\n" \
-           f"/broadcast - Broadcast message to users\n\n" \
-           f"/download - Download all user data\n\n" \
+           f"/broadcast - Broadcast message to users\n" \
+           f"Filters: joined, verified, wallet, notblocked, lang=en, since=2024-01-01, until=2024-02-01\n" \
+           f"Ex: /broadcast joined lang=en\n\n" \
+           f"/download - Download all user data\n" \
+           f"Ex: /download zip id,name,wallet\n\n" \
+           f"/cache - Show user cache statistics\n\n" \
+           f"/payouts - Show the withdrawals by status\n\n" \
            f"<b>Current Configuration</b>\n\n" \
            f"{variables}"
     await update.message.reply_text(text, parse_mode='HTML')
@@ -492,63 +609,83 @@ async def admin_set(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     variables.update(command.command, value)
+    if command.command == AdminCommands.SET_KEY:
+        solana_wallet.set_private_key(variables.private_key)
+        # Resume the payouts waiting for the key
+        payout_queue.wakeup.set()
 
     await update.message.reply_text(text)
 
 
+@admin_only
+async def cache_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text(f"<b>User Cache</b>\n\n{cache}", parse_mode='HTML')
+
+
+@admin_only
+async def payout_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    counts = await payout_queue.counts()
+    text = "".join(f"{status}: {count}\n" for status, count in sorted(counts.items())) or "No withdrawals yet"
+    await update.message.reply_text(f"<b>Withdrawals</b>\n\n{text}", parse_mode='HTML')
+
+
 # Admin command to set claimed amount equal to reward amount for all users
 @admin_only
 async def download(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    message = await update.message.reply_text("Generating csv file ...")
-
-    # Get users from the database
-    session = sqlalchemy.orm.sessionmaker(engine)()
-    users = session.query(db.User).all()
+    # /download [csv|gzip|zip] [column,column,...]
+    args = context.args or []
+    try:
+        fmt = args[0] if len(args) > 0 else "csv"
+        columns = export.parse_columns(args[1]) if len(args) > 1 else None
+    except export.ExportError as e:
+        await update.message.reply_text(e.message)
+        return
 
-    # Create a CSV file in-memory
-    csv_output = StringIO()
-    csv_writer = csv.writer(csv_output)
-    csv_writer.writerow(["User Id", "Name", "Wallet Address", "Reward Amount", "Claimed Amount", "Balance Amount"])
+    message = await update.message.reply_text(f"Generating {fmt} file ...")
 
-    # Populate the CSV file with user data
-    for user in users:
-        csv_writer.writerow([user.user_id, user.full_name, user.wallet, user.reward, user.claimed, user.balance])
-    csv_output.seek(0)
+    try:
+        output, filename = await export.export_users(Session,
+                                                     fmt=fmt,
+                                                     columns=columns,
+                                                     batch_size=user_cfg["Export"]["batch_size"],
+                                                     spool_size=user_cfg["Export"]["spool_size"])
+    except export.ExportError as e:
+        await message.edit_text(e.message)
+        return
 
     # delete loading message
     await message.delete()
-    # Send the original CSV file to the user as a document
-    await update.message.reply_document(
-        document=csv_output.getvalue().encode(),
-        filename="user_data.csv",
-        caption="User data."
-    )
+    # Send the file to the user as a document
+    # python-telegram-bot reads the whole file into memory before uploading it, so the peak memory of an export is
+    # the size of the output file: the gzip and zip formats keep it several times smaller than csv
+    with output:
+        await update.message.reply_document(
+            document=output,
+            filename=filename,
+            caption="User data."
+        )
 
 
 @admin_only
 async def ask_broadcast_msg(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("Please send a message you want to broadcast\n"
+    try:
+        segment = Segment.parse(context.args or [])
+    except SegmentError as e:
+        await update.message.reply_text(e.message)
+        return ConversationHandler.END
+    context.user_data['broadcast_segment'] = segment
+    await update.message.reply_text(f"Please send a message you want to broadcast to {segment}\n"
                                     "Press /cancel to cancel.")
     return BROADCAST
 
 
 async def send_broadcast_msg(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("Broadcast started")
-    session = sqlalchemy.orm.sessionmaker(engine)()
-    users = session.query(db.User).all()
-    session.close()
-    count = 1
-    for user in users:
-        try:
-            await update.message.copy(chat_id=user.user_id)
-            if count % 100 == 0:
-                await update.message.reply_text(f"Sent to {count} users")
-        except Exception as e:
-            pass
-        count += 1
-        await asyncio.sleep(0.01)
-
-    await update.message.reply_text("Broadcast completed!")
+    job_id = await broadcast_jobs.create(context.bot,
+                                         admin_chat_id=update.message.chat_id,
+                                         from_chat_id=update.message.chat_id,
+                                         message_id=update.message.message_id,
+                                         segment=context.user_data.pop('broadcast_segment', None))
+    await broadcast_jobs.run(context.bot, job_id)
 
 
 @admin_only
@@ -558,14 +695,8 @@ async def start_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # Function to start the verification process
 async def start_verification(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    # Generate two random values for the sum verification
-
-    image = ImageCaptcha()
-
-    correct_value = random.randint(1000, 9999)
-    correct_value = str(correct_value)
-
-    data = image.generate(correct_value)
+    # Take a pre-rendered captcha from the pool
+    correct_value, data = await captchas.get()
 
     # Save the correct sum in the context
     context.user_data['correct_value'] = correct_value
@@ -587,7 +718,7 @@ async def verify_captcha(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
     # Check if the user's sum matches the correct sum
     if user_response == correct_value:
-        cache.update_user(update.effective_user.id, {'verified': True})
+        await cache.update_user(update.effective_user.id, {'verified': True})
         await update.message.reply_text("Congratulations! You've verified you are human!.\n"
                                         "Press /start to start using the bot.")
     else:
@@ -602,9 +733,10 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Cancels and ends the conversation."""
     query = update.callback_query
     notification = "Cancelling operation"
+    loc = await get_localization(update)
     text = loc.get("conversation_open_user_menu")
     await query.answer(notification)
-    await query.message.reply_text(text=text, reply_markup=create_start_menu(), parse_mode='HTML')
+    await query.message.reply_text(text=text, reply_markup=create_start_menu(loc), parse_mode='HTML')
     await query.delete_message()
 
     return ConversationHandler.END
@@ -616,7 +748,7 @@ async def help(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 
 async def chat_join_request(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle chat join requests"""
-    user = cache.get_user(update.chat_join_request.user_chat_id)
+    user = await cache.get_user(update.chat_join_request.user_chat_id)
 
     if not user.verified:
         await update.chat_join_request.decline()
@@ -624,24 +756,24 @@ async def chat_join_request(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     else:
         await update.chat_join_request.approve()
+        membership.set(user.user_id, True)
 
     # prevent getting duplicate joins
     if user.joined:
         return
 
-    cache.update_user(user.user_id, {'joined': True})
+    if not await cache.mark_joined(user.user_id, user.referred_by_id, variables.reward_amount):
+        return
 
-    if user.referred_by:
-        session = sqlalchemy.orm.sessionmaker(bind=engine)()
-        session.query(db.User).filter_by(user_id=user.referred_by_id).update(
-            {'reward': db.User.reward + variables.reward_amount},
-            synchronize_session=False)
-        session.commit()
-        session.close()
+    stats.user_joined(referred=user.referred_by_id is not None, reward=variables.reward_amount)
+    if user.referred_by_id:
+        leaderboard.add(user.referred_by_id, user.created_at)
 
+    if user.referred_by:
+        loc = localizations.get(user.language)
         message = await context.bot.send_message(chat_id=user.user_id,
                                                  text=loc.get("conversation_open_user_menu"),
-                                                 reply_markup=create_start_menu(),
+                                                 reply_markup=create_start_menu(loc),
                                                  parse_mode='HTML')
         await context.bot.send_message(chat_id=user_cfg['Telegram']['group_id'],
                                        text=f"{user.mention()} was referred by {user.referred_by.mention()}",
@@ -653,67 +785,75 @@ async def chat_join_request(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 async def handle_wallet_address(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    cache.update_user(update.effective_user.id, {'wallet': update.message.text})
+    address = update.message.text.strip()
+    loc = await get_localization(update)
+    if not payments.solana.is_wallet_address(address):
+        await update.message.reply_text("This is not a valid SOLANA wallet address, please send it again.",
+                                        reply_markup=create_cancel_menu(loc))
+        return COLLECTING_WALLET
+
+    try:
+        wallet_valid = await solana_wallet.is_valid_address(address)
+    except payments.rpc.RPCError as e:
+        # The address is well formed, it is checked again on the next withdraw
+        logger.warning(f"Wallet check of {update.effective_user.id} failed: {e.message}")
+        wallet_valid = None
+    if wallet_valid is False:
+        await update.message.reply_text("This wallet does not exist on the SOLANA network, please send another one.",
+                                        reply_markup=create_cancel_menu(loc))
+        return COLLECTING_WALLET
+
+    await cache.update_user(update.effective_user.id, {
+        'wallet': address,
+        'wallet_valid': wallet_valid,
+        'wallet_checked_at': datetime.datetime.utcnow() if wallet_valid else None,
+    })
     await update.message.reply_text("Thank you, Your wallet address saved. This will be used to send rewards.")
-    await update.message.reply_text(text=loc.get("conversation_open_user_menu"), reply_markup=create_start_menu(),
+    await update.message.reply_text(text=loc.get("conversation_open_user_menu"), reply_markup=create_start_menu(loc),
                                     parse_mode='HTML')
     return ConversationHandler.END
 
 
-async def is_user_member(bot, chat_id, user_id):
-    try:
-        # Get information about the user's membership in the chat
-        chat_member = await bot.get_chat_member(chat_id, user_id)
-        return chat_member.status in ['member', 'administrator', 'creator']
-    except Exception as e:
-        # Handle exceptions (e.g., user not found, bot not in the group)
-        logger.debug(f"Error checking user membership: {e}")
+async def check_wallet(user):
+    """Tell whether the wallet of the user exists on the chain, trusting a successful check for wallet_check_ttl seconds"""
+    if user.wallet is None:
         return False
+    ttl = datetime.timedelta(seconds=user_cfg['Payments']['wallet_check_ttl'])
+    if user.wallet_valid and datetime.datetime.utcnow() - user.wallet_checked_at < ttl:
+        return True
+    wallet_valid = await solana_wallet.is_valid_address(user.wallet)
+    await cache.update_user(user.user_id, {'wallet_valid': wallet_valid,
+                                           'wallet_checked_at': datetime.datetime.utcnow()})
+    return wallet_valid
+
+
+async def is_user_member(bot, chat_id, user_id):
+    return await membership.is_member(bot, chat_id, user_id)
+
+
+async def chat_member_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Keep the membership cache in sync with the users joining and leaving the group"""
+    chat_member = update.chat_member
+    if str(chat_member.chat.id) != str(user_cfg['Telegram']['group_id']):
+        return
+    membership.update_status(chat_member.new_chat_member.user.id, chat_member.new_chat_member.status)
+    admins.update_status(chat_member.new_chat_member.user.id, chat_member.new_chat_member.status)
 
 
 # Function to get top referrals for a specific period
 def get_top_referrals(period: str, limit: int):
-    today = datetime.datetime.utcnow()
-
-    if period == 'daily':
-        start_date = today.replace(hour=0, minute=0, second=0, microsecond=0)
-    elif period == 'weekly':
-        start_date = today - datetime.timedelta(days=today.weekday())
-        start_date = start_date.replace(hour=0, minute=0, second=0, microsecond=0)
-    elif period == 'all':
-        start_date = datetime.datetime.min
-    else:
-        raise ValueError("Invalid period. Supported periods: 'daily', 'weekly', 'all'")
-    session = sqlalchemy.orm.sessionmaker(engine)()
-    top_referrals = (
-        session.query(db.User.referred_by_id, func.count(db.User.user_id).label('referral_count'))
-        .filter(db.User.joined == True, db.User.created_at >= start_date, db.User.referred_by_id.isnot(None))
-        .group_by(db.User.referred_by_id)
-        .order_by(func.count(db.User.user_id).desc())
-        .limit(limit)
-        .all()
-    )
-    session.close()
-    return top_referrals
+    return leaderboard.top(period, limit)
 
 
 async def get_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    session = sqlalchemy.orm.sessionmaker(engine)()
-    total_users = session.query(db.User).count()
-    total_referrals = session.query(func.count(db.User.user_id)).filter(db.User.referred_by_id.isnot(None)).scalar()
-    total_joined = session.query(func.count(db.User.user_id)).filter(db.User.referred_by_id.isnot(None)).filter(
-        db.User.joined.is_(True)).scalar()
-    total_rewards = session.query(func.sum(db.User.reward)).scalar()
-    total_claimed = session.query(func.sum(db.User.claimed)).scalar()
-    session.close()
-
+    loc = await get_localization(update)
     text = loc.get(
         "text_bot_stat",
-        total_users=total_users,
-        total_referrals=total_referrals,
-        total_joined=total_joined,
-        total_rewards=round(total_rewards, 2),
-        total_claimed=round(total_claimed, 2)
+        total_users=stats.total_users,
+        total_referrals=stats.total_referrals,
+        total_joined=stats.total_joined,
+        total_rewards=round(stats.total_rewards, 2),
+        total_claimed=round(stats.total_claimed, 2)
     )
     reply_markup = None
     if user_cfg['Telegram']['ads_contact']:
@@ -735,9 +875,68 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         print(update)
 
 
+async def refresh_admins(bot):
+    # the group is read on every refresh, as it can change with the config file
+    await admins.refresh(bot, user_cfg['Telegram']['group_id'])
+
+
+async def post_init(application: Application):
+    """Prepare the database before the bot starts processing updates."""
+    async with engine.begin() as connection:
+        logger.debug("Creating all missing tables...")
+        await connection.run_sync(db.TableDeclarativeBase.metadata.create_all)
+        logger.debug("Upgrading the existing tables...")
+        await connection.run_sync(db.upgrade)
+
+    logger.debug("Building the leaderboard...")
+    await leaderboard.build()
+    background_tasks.append(asyncio.create_task(
+        run_periodically(user_cfg["Cache"]["leaderboard_check_interval"], leaderboard.check)
+    ))
+
+    await stats.refresh()
+    background_tasks.append(asyncio.create_task(
+        run_periodically(user_cfg["Cache"]["stats_refresh_interval"], stats.refresh)
+    ))
+
+    background_tasks.append(asyncio.create_task(broadcast_jobs.resume_all(application.bot)))
+
+    await captchas.start()
+
+    background_tasks.append(asyncio.create_task(
+        run_periodically(user_cfg["Cache"]["config_reload_interval"], user_cfg.check)
+    ))
+
+    payout_queue.on_update = partial(report_payout, application.bot)
+    background_tasks.append(asyncio.create_task(payout_queue.run()))
+    background_tasks.append(asyncio.create_task(
+        run_periodically(user_cfg["Payments"]["confirmation_interval"], confirmation_tracker.check)
+    ))
+
+    await admins.load()
+    await refresh_admins(application.bot)
+    background_tasks.append(asyncio.create_task(
+        run_periodically(user_cfg["Cache"]["admin_refresh_interval"], refresh_admins, application.bot)
+    ))
+
+
+async def post_shutdown(application: Application):
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    await payout_queue.stop()
+    await captchas.stop()
+    await solana_wallet.close()
+    await engine.dispose()
+
+
 def main() -> None:
     # Create the Application and pass it your bot's token.
-    application = Application.builder().token(user_cfg["Telegram"]["token"]).build()
+    application = Application.builder() \
+        .token(user_cfg["Telegram"]["token"]) \
+        .post_init(post_init) \
+        .post_shutdown(post_shutdown) \
+        .build()
 
     start_handler = ConversationHandler(
         entry_points=[CommandHandler("start", start)],
@@ -776,6 +975,8 @@ def main() -> None:
     # Admin commands
     application.add_handler(CommandHandler("admin", admin_help))
     application.add_handler(CommandHandler("download", download))
+    application.add_handler(CommandHandler("cache", cache_stats))
+    application.add_handler(CommandHandler("payouts", payout_stats))
 
     # Commands to set variables
     application.add_handler(CommandHandler(admin_commands.SET_KEY, admin_set))
@@ -788,6 +989,7 @@ def main() -> None:
     application.add_handler(CommandHandler(admin_commands.SET_AD_URL, admin_set))
 
     application.add_handler(ChatJoinRequestHandler(chat_join_request))
+    application.add_handler(ChatMemberHandler(chat_member_update, ChatMemberHandler.CHAT_MEMBER))
     application.add_error_handler(error_handler)
 
     # Run the bot until the user presses Ctrl-C
@@ -0,0 +1,45 @@
+import logging
+
+from cachetools import TTLCache
+
+log = logging.getLogger(__name__)
+
+# Chat member statuses that count as being part of the group
+MEMBER_STATUSES = ("member", "administrator", "creator")
+
+
+class MembershipCache:
+    """Remember for a while whether users are members of the group, so that most checks need no Telegram call.
+
+    Entries are kept fresh by the chat member and join request updates, the ttl only bounds how long a missed
+    update can leave a wrong answer around."""
+
+    def __init__(self, maxsize=10000, ttl=300):
+        self.members = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    async def is_member(self, bot, chat_id, user_id) -> bool:
+        is_member = self.members.get(user_id)
+        if is_member is not None:
+            return is_member
+
+        try:
+            # Get information about the user's membership in the chat
+            chat_member = await bot.get_chat_member(chat_id, user_id)
+        except Exception as e:
+            # Handle exceptions (e.g., user not found, bot not in the group), without caching the failure
+            log.debug(f"Error checking user membership: {e}")
+            return False
+
+        is_member = chat_member.status in MEMBER_STATUSES
+        self.members[user_id] = is_member
+        return is_member
+
+    def set(self, user_id, is_member: bool):
+        self.members[user_id] = is_member
+
+    def update_status(self, user_id, status: str):
+        """Update the membership of a user from a chat member status."""
+        self.set(user_id, status in MEMBER_STATUSES)
+
+    def invalidate(self, user_id):
+        self.members.pop(user_id, None)
@@ -0,0 +1,83 @@
+import asyncio
+import logging
+
+import solathon.utils
+
+from payments.wallet import NotEnoughBalanceError
+
+log = logging.getLogger(__name__)
+
+
+class PayoutBatcher:
+    """Collect the transfers requested within a short window and pack them into as few transactions as possible.
+
+    Every transfer still resolves to the SentTransaction that carried it. A transaction holds at most
+    max_transfers transfers, which has to keep it under the 1232 bytes Solana accepts (about 20 transfers).
+    The on_signed callbacks of a batch are awaited with the SignedTransaction before it is sent, so the caller can
+    store the signature first; if one of them fails the transaction is not sent."""
+
+    def __init__(self, wallet, window: float = 2.0, max_transfers: int = 16):
+        self.wallet = wallet
+        self.window = window
+        self.max_transfers = max_transfers
+        # (address, lamports, on_signed, future) waiting for the next transaction
+        self.pending = []
+        self.flusher = None
+        # eager flushes of full batches, referenced until they finish as the event loop only keeps weak references
+        self.flushes = set()
+        # one batch at a time, each one is admitted against the balance left by the previous one
+        self.lock = asyncio.Lock()
+
+    async def transfer(self, address, amount, on_signed=None):
+        """Queue a transfer of amount SOL to address and wait for the transaction carrying it."""
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((address, solathon.utils.sol_to_lamport(amount), on_signed, future))
+        if len(self.pending) >= self.max_transfers:
+            if self.flusher is not None:
+                self.flusher.cancel()
+                self.flusher = None
+            task = asyncio.create_task(self.flush())
+            self.flushes.add(task)
+            task.add_done_callback(self.flushes.discard)
+        elif self.flusher is None:
+            self.flusher = asyncio.create_task(self._flush_later())
+        return await future
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.window)
+        self.flusher = None
+        await self.flush()
+
+    async def flush(self):
+        """Send every queued transfer, max_transfers per transaction."""
+        async with self.lock:
+            while self.pending:
+                batch, self.pending = self.pending[:self.max_transfers], self.pending[self.max_transfers:]
+                try:
+                    await self._send(batch)
+                except Exception as e:
+                    log.error(f"Payout batch of {len(batch)} transfers failed: {e}")
+                    self.wallet.reconcile()
+                    for *_, future in batch:
+                        if not future.done():
+                            future.set_exception(e)
+
+    async def _send(self, batch):
+        # Admit transfers in order while the wallet can afford them, the remaining ones fail on their own
+        available = await self.wallet.balance() - self.wallet.SIGNATURE_FEE
+        admitted = []
+        for address, lamports, on_signed, future in batch:
+            if lamports < available:
+                available -= lamports
+                admitted.append((address, lamports, on_signed, future))
+            else:
+                future.set_exception(NotEnoughBalanceError())
+        if not admitted:
+            return
+
+        signed = await self.wallet.sign_many([(address, lamports) for address, lamports, _, _ in admitted])
+        await asyncio.gather(*(on_signed(signed) for _, _, on_signed, _ in admitted if on_signed is not None))
+        sent = await self.wallet.submit(signed)
+        log.debug(f"Sent {len(admitted)} transfers in {sent.url}")
+        for *_, future in admitted:
+            future.set_result(sent)
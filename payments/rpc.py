@@ -0,0 +1,152 @@
+import base64
+import itertools
+import logging
+import time
+
+import httpx
+
+log = logging.getLogger(__name__)
+
+
+class RPCError(Exception):
+    def __init__(self, message="Solana RPC request failed"):
+        self.message = message
+        super().__init__(self.message)
+
+
+class RPCTransportError(RPCError):
+    """The request failed on an endpoint without an answer, it may or may not have been processed."""
+
+
+class Endpoint:
+    """Health of one RPC endpoint: moving averages of its latency and error rate, and a circuit breaker."""
+
+    # Weight of the newest sample in the moving averages
+    ALPHA = 0.2
+
+    def __init__(self, url: str, *, failure_threshold: int = 3, cooldown: float = 30):
+        self.url = url
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.latency = 0.0
+        self.error_rate = 0.0
+        self.failures = 0
+        self.open_until = 0.0
+
+    def available(self, now: float) -> bool:
+        """Whether the circuit is closed, or half open after the cooldown to let one request probe the endpoint."""
+        return now >= self.open_until
+
+    def score(self) -> float:
+        # Endpoints without samples score 0 and are tried first
+        return self.latency * (1 + 10 * self.error_rate)
+
+    def record_success(self, latency: float):
+        self.latency += self.ALPHA * (latency - self.latency)
+        self.error_rate -= self.ALPHA * self.error_rate
+        self.failures = 0
+
+    def record_failure(self, now: float):
+        self.error_rate += self.ALPHA * (1 - self.error_rate)
+        self.failures += 1
+        if self.failures >= self.failure_threshold:
+            log.warning(f"Opening the circuit of {self.url} for {self.cooldown} seconds")
+            self.open_until = now + self.cooldown
+
+    def __str__(self):
+        return f"{self.url}: latency {self.latency * 1000:.0f} ms, error rate {self.error_rate:.2f}, " \
+               f"{'open' if not self.available(time.monotonic()) else 'closed'}"
+
+
+class RPCClient:
+    """Asynchronous Solana JSON-RPC client, sending every request over one pool of keep-alive connections.
+    Requests go to the healthiest of the endpoints and are retried on the next one when an endpoint fails."""
+
+    # The most signatures getSignatureStatuses accepts at once
+    MAX_SIGNATURES = 256
+
+    def __init__(self, endpoints, *, timeout: float = 10, max_connections: int = 10,
+                 failure_threshold: int = 3, cooldown: float = 30, http: httpx.AsyncClient = None):
+        if isinstance(endpoints, str):
+            endpoints = [endpoints]
+        if not endpoints:
+            raise ValueError("At least one RPC endpoint is required")
+        self.endpoints = [Endpoint(url, failure_threshold=failure_threshold, cooldown=cooldown)
+                          for url in endpoints]
+        self.http = http or httpx.AsyncClient(
+            timeout=httpx.Timeout(timeout),
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+        )
+        self.ids = itertools.count(1)
+
+    def candidates(self):
+        """The endpoints in the order they should be tried: the available ones by score, then the open circuits
+        by the time they close, so that a request is still attempted when every endpoint is failing."""
+        now = time.monotonic()
+        available = sorted((e for e in self.endpoints if e.available(now)), key=Endpoint.score)
+        opened = sorted((e for e in self.endpoints if not e.available(now)), key=lambda e: e.open_until)
+        return available + opened
+
+    async def request(self, method: str, params: list = None):
+        """Call a JSON-RPC method and return its result."""
+        payload = {"jsonrpc": "2.0", "id": next(self.ids), "method": method}
+        if params is not None:
+            payload["params"] = params
+        error = None
+        for endpoint in self.candidates():
+            started = time.monotonic()
+            try:
+                response = await self.http.post(endpoint.url, json=payload)
+                response.raise_for_status()
+                data = response.json()
+            except (httpx.HTTPError, ValueError) as e:
+                # Timeouts, connection errors, rate limits and garbage responses are failures of the endpoint
+                # Retrying is safe for sendTransaction too, a signed transaction is only executed once per signature
+                endpoint.record_failure(time.monotonic())
+                log.debug(f"{method} failed on {endpoint.url}: {e!r}")
+                error = e
+                continue
+            endpoint.record_success(time.monotonic() - started)
+            # An error answered by the node is about the request itself, another endpoint would give the same
+            if "error" in data:
+                message = f"{method} failed: {data['error'].get('message', data['error'])}"
+                if error is not None:
+                    # An endpoint failed before, it may have processed the request and caused this error,
+                    # like a transaction reported as already processed
+                    raise RPCTransportError(f"{message}, after {error!r}")
+                raise RPCError(message)
+            return data["result"]
+        raise RPCTransportError(f"{method} failed on every endpoint: {error!r}")
+
+    async def get_account_info(self, address):
+        """Return the account of the address, None if it does not exist."""
+        result = await self.request("getAccountInfo", [str(address), {"encoding": "base64"}])
+        return result["value"]
+
+    async def get_balance(self, address) -> int:
+        """Return the balance of the address in lamports."""
+        result = await self.request("getBalance", [str(address)])
+        return result["value"]
+
+    async def get_latest_blockhash(self) -> str:
+        result = await self.request("getLatestBlockhash")
+        return result["value"]["blockhash"]
+
+    async def is_blockhash_valid(self, blockhash: str) -> bool:
+        """Whether transactions built on the blockhash can still be processed."""
+        result = await self.request("isBlockhashValid", [blockhash, {"commitment": "processed"}])
+        return result["value"]
+
+    async def get_signature_statuses(self, signatures: list) -> list:
+        """Return the status of each signature, None for the transactions the node does not know.
+        A single request takes at most MAX_SIGNATURES signatures."""
+        result = await self.request("getSignatureStatuses", [signatures, {"searchTransactionHistory": True}])
+        return result["value"]
+
+    async def send_transaction(self, wire_transaction: bytes) -> str:
+        """Submit a signed transaction and return its signature."""
+        encoded = base64.b64encode(wire_transaction).decode("utf-8")
+        return await self.request("sendTransaction", [encoded, {"encoding": "base64"}])
+
+    async def close(self):
+        await self.http.aclose()
@@ -1,11 +1,36 @@
+import time
+from collections import namedtuple
+
+import base58
+import nacl.bindings
 import solathon.utils
-from solathon import AsyncClient, Client, Transaction, PublicKey, Keypair
+from solathon import Client, Transaction, PublicKey, Keypair
 from solathon.core.instructions import transfer
 
-from payments.wallet import Wallet, InvalidAddressError, NotEnoughBalanceError
+from payments.rpc import RPCClient, RPCError, RPCTransportError
+from payments.wallet import Wallet, InvalidAddressError, NotEnoughBalanceError, TransactionUnknownError
 
 ENDPOINT = "https://api.mainnet-beta.solana.com"
 
+# A transaction sent to the network, it is valid until its blockhash expires
+SentTransaction = namedtuple("SentTransaction", ["signature", "blockhash", "url"])
+# A transaction signed but not sent yet, wire is its serialized form and lamports what it takes from the wallet
+SignedTransaction = namedtuple("SignedTransaction", ["signature", "blockhash", "url", "wire", "lamports"])
+
+
+def transaction_url(signature: str) -> str:
+    return f"https://solscan.io/tx/{signature}"
+
+
+def is_wallet_address(address) -> bool:
+    """Check offline that the address is a base58 encoded ed25519 public key.
+    Addresses off the curve, like program derived addresses, can not own a wallet."""
+    try:
+        key = base58.b58decode(address.strip())
+    except ValueError:
+        return False
+    return len(key) == 32 and nacl.bindings.crypto_core_ed25519_is_valid_point(key)
+
 
 class SolanaWallet(Wallet):
     def __init__(self, endpoint):
@@ -71,24 +96,46 @@ class SolanaWallet(Wallet):
 
 
 class SolanaAsyncWallet(Wallet):
-    def __init__(self, endpoint):
-        self.client = AsyncClient(endpoint)
+    """Solana wallet using the asynchronous RPC client, so that payments never block the event loop."""
+
+    # Lamports paid for each signature of a transaction
+    SIGNATURE_FEE = 5000
+
+    def __init__(self, endpoints, *, timeout=10, max_connections=10, failure_threshold=3, cooldown=30,
+                 balance_ttl=300, blockhash_ttl=30):
+        self.client = RPCClient(endpoints, timeout=timeout, max_connections=max_connections,
+                                failure_threshold=failure_threshold, cooldown=cooldown)
+        self.keypair = None
+        # The balance of the hot wallet, debited locally after each send and reloaded every balance_ttl seconds
+        self.balance_ttl = balance_ttl
+        self.cached_balance = None
+        self.balance_updated = 0.0
+        # A recent blockhash stays valid for about a minute, so one is reused for blockhash_ttl seconds
+        self.blockhash_ttl = blockhash_ttl
+        self.blockhash = None
+        self.blockhash_updated = 0.0
         super().__init__()
 
+    def set_private_key(self, key):
+        if key == self.key:
+            return
+        super().set_private_key(key)
+        # Derive the keypair once per key, instead of on every send
+        self.keypair = Keypair.from_private_key(key) if key else None
+        self.address = self.keypair.public_key if self.keypair else ""
+        self.cached_balance = None
+
     @property
     def public_key(self):
         if self.is_private_key_set():
-            if self.address == "":
-                self.address = Keypair.from_private_key(self.key).public_key
             return self.address
 
     async def is_valid_address(self, address):
-        res = await self.client.get_account_info(address)
-        if 'result' in res:
-            value = res['result'].get('value')
-            return value is not None
-        else:
+        """Check that the address is a wallet existing on the chain.
+        Malformed addresses are rejected without any request, RPCError is raised if the node can not tell."""
+        if not is_wallet_address(address):
             return False
+        return await self.client.get_account_info(address) is not None
 
     async def send(self, address, amount):
         if not await self.is_valid_address(address):
@@ -96,26 +143,77 @@ class SolanaAsyncWallet(Wallet):
 
         if self.is_private_key_set():
             lamports = solathon.utils.sol_to_lamport(amount)
-            if lamports >= await self.balance():
+            if lamports + self.SIGNATURE_FEE > await self.balance():
                 raise NotEnoughBalanceError
-            sender = Keypair.from_private_key(self.key)
-            receiver = PublicKey(address)
+            sent = await self.send_many([(address, lamports)])
+            return sent.url
 
-            instruction = transfer(
-                from_public_key=sender.public_key,
-                to_public_key=receiver,
-                lamports=lamports,
-            )
-
-            transaction = Transaction(instructions=[instruction], signers=[sender])
+    async def send_many(self, transfers) -> SentTransaction:
+        """Send several (address, lamports) transfers with a single transaction.
+        The addresses and the balance are expected to be checked already."""
+        if self.is_private_key_set():
+            return await self.submit(await self.sign_many(transfers))
 
-            result = await self.client.send_transaction(transaction)
-            tx_url = f"https://solscan.io/tx/{result}"
-            return tx_url
+    async def sign_many(self, transfers) -> SignedTransaction:
+        """Build and sign a transaction with several (address, lamports) transfers, without sending it.
+        The signature identifies the transaction on the chain, so it can be stored before the transaction leaves."""
+        if self.is_private_key_set():
+            sender = self.keypair
+
+            instructions = [
+                transfer(
+                    from_public_key=sender.public_key,
+                    to_public_key=PublicKey(address),
+                    lamports=lamports,
+                )
+                for address, lamports in transfers
+            ]
+
+            blockhash = await self.recent_blockhash()
+            transaction = Transaction(instructions=instructions, signers=[sender], recent_blockhash=blockhash)
+            transaction.sign()
+            signature = base58.b58encode(transaction.signatures[0].signature).decode()
+            lamports = sum(lamports for _, lamports in transfers) + self.SIGNATURE_FEE
+            return SignedTransaction(signature, blockhash, transaction_url(signature), transaction.serialize(), lamports)
+
+    async def submit(self, signed: SignedTransaction) -> SentTransaction:
+        """Send a transaction returned by sign_many."""
+        try:
+            await self.client.send_transaction(signed.wire)
+        except RPCTransportError as e:
+            # The transaction may have reached a node, sending the transfers again could pay them twice
+            self.blockhash = None
+            self.reconcile()
+            raise TransactionUnknownError(e.message, signature=signed.signature, blockhash=signed.blockhash) from e
+        except RPCError:
+            # The blockhash may have expired and the balance may have changed, reload both next time
+            self.blockhash = None
+            self.reconcile()
+            raise
+        self.debit(signed.lamports)
+        return SentTransaction(signed.signature, signed.blockhash, signed.url)
+
+    async def recent_blockhash(self) -> str:
+        if self.blockhash is None or time.monotonic() - self.blockhash_updated > self.blockhash_ttl:
+            self.blockhash = await self.client.get_latest_blockhash()
+            self.blockhash_updated = time.monotonic()
+        return self.blockhash
 
     async def balance(self) -> int:
-        res = await self.client.get_balance(self.public_key)
-        if 'result' in res:
-            return res['result']['value']
-        else:
-            raise res['error']
+        """The balance of the wallet in lamports, reconciled with the chain every balance_ttl seconds."""
+        if self.cached_balance is None or time.monotonic() - self.balance_updated > self.balance_ttl:
+            self.cached_balance = await self.client.get_balance(self.public_key)
+            self.balance_updated = time.monotonic()
+        return self.cached_balance
+
+    def debit(self, lamports: int):
+        """Account locally for lamports that left the wallet."""
+        if self.cached_balance is not None:
+            self.cached_balance -= lamports
+
+    def reconcile(self):
+        """Reload the balance from the chain on the next read, e.g. after a failure."""
+        self.cached_balance = None
+
+    async def close(self):
+        await self.client.close()
@@ -16,6 +16,14 @@ class NotEnoughBalanceError(Exception):
         super().__init__(self.message)
 
 
+class TransactionUnknownError(Exception):
+    def __init__(self, message="The transaction was sent but its outcome is unknown", signature=None, blockhash=None):
+        self.message = message
+        self.signature = signature
+        self.blockhash = blockhash
+        super().__init__(self.message)
+
+
 class Wallet:
     def __init__(self):
         self.key = None
@@ -0,0 +1,285 @@
+import asyncio
+import datetime
+import logging
+
+from sqlalchemy import select, update, func
+from sqlalchemy.exc import IntegrityError
+
+from database import User, Payout
+from payments.rpc import RPCClient, RPCError
+from payments.solana import transaction_url
+from payments.wallet import NotEnoughBalanceError, PrivateKeyNoneError, TransactionUnknownError
+
+log = logging.getLogger(__name__)
+
+
+class PayoutConflictError(Exception):
+    def __init__(self, message="A withdrawal of this balance is already in progress"):
+        self.message = message
+        super().__init__(self.message)
+
+
+class PayoutQueue:
+    """Send withdrawals in the background from a queue persisted in the database.
+
+    Enqueueing moves the balance of the user to claimed and stores the payout in one transaction. The update only
+    applies if claimed still has the value the balance was computed from, and the payout key is unique per user
+    and claimed value, so concurrent or repeated withdrawals of the same balance are refused. A refunded payout
+    releases its key, as claimed goes back to the value it was built from.
+    The signature of the transaction is stored before the transaction is sent, so a payout interrupted at any
+    point is either known to be unsent or can be followed by the ConfirmationTracker.
+    Failures before the transaction is sent are retried with an exponential backoff; after max_attempts the
+    payout fails and the amount is given back to the user. A payout whose transaction may have been sent is
+    never sent again before the tracker knows it was dropped. Nothing is sent while the wallet has no private key,
+    the queue waits for it without using up attempts."""
+
+    def __init__(self, session_factory, batcher, workers: int = 16, max_attempts: int = 5,
+                 retry_delay: float = 30, poll_interval: float = 5):
+        self.session_factory = session_factory
+        self.batcher = batcher
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.poll_interval = poll_interval
+        # Coroutine called with each payout which reached sent, confirmed or failed
+        self.on_update = None
+        self.inflight = set()
+        self.wakeup = asyncio.Event()
+        self.paused = False
+
+    async def enqueue(self, user) -> Payout:
+        amount = user.balance
+        if user.claimed is None:
+            unchanged = User.claimed.is_(None)
+        else:
+            unchanged = User.claimed == user.claimed
+        async with self.session_factory() as session:
+            result = await session.execute(
+                update(User).where(User.user_id == user.user_id, unchanged)
+                .values(claimed=func.coalesce(User.claimed, 0) + amount)
+                .execution_options(synchronize_session=False)
+            )
+            if not result.rowcount:
+                raise PayoutConflictError
+            payout = Payout(user_id=user.user_id,
+                            idempotency_key=f"{user.user_id}:{user.claimed or 0}",
+                            wallet=user.wallet,
+                            amount=amount)
+            session.add(payout)
+            try:
+                await session.commit()
+            except IntegrityError:
+                await session.rollback()
+                raise PayoutConflictError
+        log.info(f"Queued payout {payout.payout_id} of {amount} to {user.user_id}")
+        self.wakeup.set()
+        return payout
+
+    async def recover(self) -> int:
+        """Resume the payouts which were in flight when the bot stopped.
+        Those with a signature are followed by the ConfirmationTracker, the others were never sent and are queued."""
+        async with self.session_factory() as session:
+            signed = await session.execute(
+                update(Payout).where(Payout.status == "sending", Payout.signature.isnot(None)).values(status="sent")
+            )
+            unsigned = await session.execute(
+                update(Payout).where(Payout.status == "sending", Payout.signature.is_(None)).values(status="queued")
+            )
+            await session.commit()
+        if signed.rowcount or unsigned.rowcount:
+            log.warning(f"{signed.rowcount + unsigned.rowcount} payouts were interrupted while sending,"
+                        f" {signed.rowcount} of them are tracked and {unsigned.rowcount} queued again")
+        return signed.rowcount + unsigned.rowcount
+
+    async def counts(self) -> dict:
+        """Return the number of payouts in each status."""
+        async with self.session_factory() as session:
+            result = await session.execute(select(Payout.status, func.count()).group_by(Payout.status))
+            return dict(result.all())
+
+    async def run(self):
+        """Dispatch the due payouts to at most workers concurrent transfers, forever."""
+        await self.recover()
+        while True:
+            self.wakeup.clear()
+            free = self.workers - len(self.inflight)
+            if not self.batcher.wallet.key:
+                if not self.paused:
+                    log.warning("The private key of the wallet is not set, payouts are paused")
+                self.paused = True
+            elif free > 0:
+                if self.paused:
+                    log.info("The private key of the wallet is set, payouts are resumed")
+                self.paused = False
+                for payout in await self._claim_due(free):
+                    task = asyncio.create_task(self._process(payout))
+                    self.inflight.add(task)
+                    task.add_done_callback(self._done)
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def stop(self, timeout: float = 30):
+        """Wait for the transfers in flight, those still running after timeout are resumed by recover() on the next
+        start."""
+        if self.inflight:
+            await asyncio.wait(self.inflight, timeout=timeout)
+
+    def _done(self, task):
+        self.inflight.discard(task)
+        self.wakeup.set()
+
+    async def _claim_due(self, limit: int) -> list:
+        """Mark up to limit due payouts as sending and return them."""
+        now = datetime.datetime.utcnow()
+        async with self.session_factory() as session:
+            result = await session.execute(
+                select(Payout).where(Payout.status == "queued", Payout.next_attempt_at <= now)
+                .order_by(Payout.payout_id).limit(limit)
+            )
+            claimed = []
+            for payout in result.scalars().all():
+                result = await session.execute(
+                    update(Payout).where(Payout.payout_id == payout.payout_id, Payout.status == "queued")
+                    .values(status="sending", attempts=Payout.attempts + 1)
+                    .execution_options(synchronize_session=False)
+                )
+                if result.rowcount:
+                    payout.status = "sending"
+                    payout.attempts += 1
+                    claimed.append(payout)
+            await session.commit()
+        return claimed
+
+    async def _process(self, payout: Payout):
+        async def on_signed(signed):
+            await self.set_status(payout, signature=signed.signature, blockhash=signed.blockhash, tx_url=signed.url)
+
+        try:
+            sent = await self.batcher.transfer(payout.wallet, payout.amount, on_signed=on_signed)
+        except PrivateKeyNoneError as e:
+            # The key was removed after the payout was claimed, it waits for a new one without losing an attempt
+            log.warning(f"Payout {payout.payout_id} is waiting for the private key of the wallet")
+            await self.set_status(payout, status="queued", attempts=payout.attempts - 1, last_error=e.message,
+                                  signature=None, blockhash=None, tx_url=None,
+                                  next_attempt_at=datetime.datetime.utcnow())
+        except (NotEnoughBalanceError, RPCError) as e:
+            # The transaction was refused, so it will never be processed
+            await self._retry_later(payout, getattr(e, "message", repr(e)))
+        except TransactionUnknownError as e:
+            # The signature of the transaction is known, the ConfirmationTracker finds out whether it went through
+            log.warning(f"Payout {payout.payout_id} may have been sent, tracking {e.signature}: {e.message}")
+            await self.set_status(payout, status="sent", signature=e.signature, blockhash=e.blockhash,
+                                  tx_url=transaction_url(e.signature), last_error=e.message)
+        except Exception as e:
+            error = getattr(e, "message", repr(e))
+            if payout.signature is not None:
+                # The failure may have happened after sending, the ConfirmationTracker finds out
+                log.error(f"Payout {payout.payout_id} may have been sent, tracking {payout.signature}: {e!r}")
+                await self.set_status(payout, status="sent", last_error=error)
+            else:
+                # The signature is stored before sending, without one the transaction never left
+                log.error(f"Payout {payout.payout_id} failed before sending: {e!r}")
+                await self._retry_later(payout, error)
+        else:
+            log.debug(f"Payout {payout.payout_id} sent in {sent.url}")
+            await self.set_status(payout, status="sent", signature=sent.signature, blockhash=sent.blockhash,
+                                  tx_url=sent.url, last_error=None)
+
+    async def _retry_later(self, payout: Payout, error: str):
+        """Queue a payout which was not sent again after a backoff, or fail and refund it after max_attempts."""
+        unsigned = dict(signature=None, blockhash=None, tx_url=None)
+        if payout.attempts < self.max_attempts:
+            delay = self.retry_delay * 2 ** (payout.attempts - 1)
+            log.warning(f"Payout {payout.payout_id} failed, retrying in {delay} seconds: {error}")
+            await self.set_status(payout, status="queued", last_error=error, **unsigned,
+                                  next_attempt_at=datetime.datetime.utcnow() + datetime.timedelta(seconds=delay))
+        else:
+            log.error(f"Payout {payout.payout_id} failed after {payout.attempts} attempts: {error}")
+            await self.set_status(payout, status="failed", last_error=error, refund=True, **unsigned)
+
+    async def set_status(self, payout: Payout, refund: bool = False, **values):
+        """Store the new values of the payout, giving its amount back to the user if refund is set."""
+        if refund:
+            # claimed goes back to the value the key was built from, release the key for the next withdrawal
+            values["idempotency_key"] = f"{payout.idempotency_key}:refunded:{payout.payout_id}"
+        async with self.session_factory() as session:
+            await session.execute(
+                update(Payout).where(Payout.payout_id == payout.payout_id).values(**values)
+                .execution_options(synchronize_session=False)
+            )
+            if refund:
+                await session.execute(
+                    update(User).where(User.user_id == payout.user_id)
+                    .values(claimed=User.claimed - payout.amount)
+                    .execution_options(synchronize_session=False)
+                )
+            await session.commit()
+        for key, value in values.items():
+            setattr(payout, key, value)
+        if values.get("status", "queued") != "queued" and self.on_update is not None:
+            try:
+                await self.on_update(payout)
+            except Exception as e:
+                log.error(f"Could not report payout {payout.payout_id}: {e!r}")
+
+
+class ConfirmationTracker:
+    """Follow the sent payouts until their transaction is confirmed, and queue them again when it was dropped.
+
+    The statuses of up to 256 transactions are read with a single getSignatureStatuses request, so hundreds of
+    payouts in flight cost a couple of requests per check. A transaction the network does not know once its
+    blockhash has expired can never be processed anymore, so sending its transfers again is safe."""
+
+    # The confirmation levels from the weakest to the strongest
+    COMMITMENTS = ["processed", "confirmed", "finalized"]
+
+    def __init__(self, session_factory, wallet, queue: PayoutQueue, commitment: str = "confirmed"):
+        if commitment not in self.COMMITMENTS:
+            raise ValueError(f"Invalid commitment. Supported commitments: {', '.join(self.COMMITMENTS)}")
+        self.session_factory = session_factory
+        self.wallet = wallet
+        self.queue = queue
+        self.confirmed = self.COMMITMENTS[self.COMMITMENTS.index(commitment):]
+
+    async def check(self):
+        async with self.session_factory() as session:
+            result = await session.execute(
+                select(Payout).where(Payout.status == "sent", Payout.signature.isnot(None)).order_by(Payout.payout_id)
+            )
+            payouts = result.scalars().all()
+        if not payouts:
+            return
+
+        # The blockhashes are checked before the statuses, a transaction still unknown afterwards is surely dropped
+        expired = set()
+        for blockhash in {payout.blockhash for payout in payouts}:
+            if not await self.wallet.client.is_blockhash_valid(blockhash):
+                expired.add(blockhash)
+
+        signatures = list(dict.fromkeys(payout.signature for payout in payouts))
+        statuses = {}
+        for start in range(0, len(signatures), RPCClient.MAX_SIGNATURES):
+            chunk = signatures[start:start + RPCClient.MAX_SIGNATURES]
+            statuses.update(zip(chunk, await self.wallet.client.get_signature_statuses(chunk)))
+
+        for payout in payouts:
+            status = statuses[payout.signature]
+            if status is None:
+                if payout.blockhash in expired:
+                    await self._retry(payout, "Transaction dropped")
+            elif status["err"] is not None:
+                # A failed transaction is rolled back entirely, none of its transfers happened
+                await self._retry(payout, f"Transaction failed: {status['err']}")
+            elif status["confirmationStatus"] in self.confirmed:
+                log.debug(f"Payout {payout.payout_id} confirmed in {payout.signature}")
+                await self.queue.set_status(payout, status="confirmed", last_error=None)
+
+    async def _retry(self, payout: Payout, error: str):
+        log.warning(f"Payout {payout.payout_id} was not paid by {payout.signature}, queueing it again: {error}")
+        # The wallet debited the transfers locally
+        self.wallet.reconcile()
+        await self.queue.set_status(payout, status="queued", signature=None, blockhash=None, tx_url=None,
+                                    last_error=error, next_attempt_at=datetime.datetime.utcnow())
+        self.queue.wakeup.set()
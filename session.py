@@ -0,0 +1,63 @@
+import logging
+
+import sqlalchemy
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+log = logging.getLogger(__name__)
+
+# The session factory used for every database access, bound to the engine at startup with Session.configure
+# Objects are not expired on commit, as they are cached and read after their session is closed
+Session = sessionmaker(class_=AsyncSession, expire_on_commit=False)
+
+# asyncio drivers used for the backends whose url does not name a driver
+ASYNC_DRIVERS = {
+    "sqlite": "aiosqlite",
+    "postgresql": "asyncpg",
+    "mysql": "aiomysql",
+}
+
+
+def async_url(url: str) -> sqlalchemy.engine.URL:
+    """Switch the url to an asyncio driver, so that the engine never blocks the event loop."""
+    url = sqlalchemy.engine.make_url(url)
+    backend = url.get_backend_name()
+    if "+" not in url.drivername and backend in ASYNC_DRIVERS:
+        url = url.set(drivername=f"{backend}+{ASYNC_DRIVERS[backend]}")
+    return url
+
+
+def create_engine(url: str, *,
+                  pool_size: int = 5,
+                  max_overflow: int = 10,
+                  pool_pre_ping: bool = True,
+                  pool_recycle: int = 3600,
+                  busy_timeout: int = 5000):
+    """Create the asyncio sqlalchemy engine with the pool settings of the config file."""
+    url = async_url(url)
+    log.debug(f"Using the {url.drivername} driver")
+    if url.get_backend_name() == "sqlite":
+        # sqlite uses a NullPool or StaticPool, the pool sizing does not apply
+        log.debug("Creating a sqlite engine with WAL journaling")
+        engine = create_async_engine(url, pool_pre_ping=pool_pre_ping)
+        _set_sqlite_pragmas(engine.sync_engine, busy_timeout)
+    else:
+        engine = create_async_engine(url,
+                                     pool_size=pool_size,
+                                     max_overflow=max_overflow,
+                                     pool_pre_ping=pool_pre_ping,
+                                     pool_recycle=pool_recycle)
+    return engine
+
+
+def _set_sqlite_pragmas(engine, busy_timeout: int):
+    """Let readers and writers work concurrently instead of serializing on the database lock."""
+
+    @event.listens_for(engine, "connect")
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute(f"PRAGMA busy_timeout={int(busy_timeout)}")
+        cursor.close()
@@ -0,0 +1,54 @@
+import logging
+
+from sqlalchemy import select, func, case
+
+from database import User
+
+log = logging.getLogger(__name__)
+
+
+class Stats:
+    """Snapshot of the aggregate bot statistics, refreshed periodically and kept up to date by the handlers."""
+
+    def __init__(self, session_factory):
+        self.session_factory = session_factory
+        self.total_users = 0
+        self.total_referrals = 0
+        self.total_joined = 0
+        self.total_rewards = 0
+        self.total_claimed = 0
+
+    async def refresh(self):
+        """Recompute every statistic with a single aggregate query."""
+        async with self.session_factory() as session:
+            result = await session.execute(
+                select(
+                    func.count(User.user_id),
+                    func.count(User.referred_by_id),
+                    func.coalesce(func.sum(case((User.referred_by_id.isnot(None) & (User.joined == True), 1),
+                                                else_=0)), 0),
+                    func.coalesce(func.sum(User.reward), 0),
+                    func.coalesce(func.sum(User.claimed), 0),
+                )
+            )
+            total_users, total_referrals, total_joined, total_rewards, total_claimed = result.one()
+
+        self.total_users = total_users
+        self.total_referrals = total_referrals
+        self.total_joined = total_joined
+        # sums come back as Decimal on some backends, which do not mix with the float rewards
+        self.total_rewards = float(total_rewards)
+        self.total_claimed = float(total_claimed)
+
+    def user_created(self, referred: bool):
+        self.total_users += 1
+        if referred:
+            self.total_referrals += 1
+
+    def user_joined(self, referred: bool, reward):
+        if referred:
+            self.total_joined += 1
+            self.total_rewards += reward
+
+    def reward_claimed(self, amount):
+        self.total_claimed += amount
@@ -123,6 +123,9 @@ lb_menu_top10 = "👐🏻 Prime 10"
 # LeaderBoard Menu: daily
 lb_menu_top20 = "🦍 Twenty Titans"
 
+# LeaderBoard Menu: any other size of the all-time ranking
+lb_menu_top_n = "🏆 Top {size}"
+
 # Emoji: unprocessed order
 emoji_not_processed = "*️⃣"
 
@@ -0,0 +1,27 @@
+import pytest
+from sqlalchemy import select
+
+from broadcast import Segment, SegmentError
+from database import User
+
+
+def sql(segment: Segment) -> str:
+    return str(select(User.user_id).where(*segment.where()))
+
+
+def test_users_who_blocked_the_bot_are_always_left_out():
+    assert "users.bot_blocked = false" in sql(Segment())
+    assert "users.blocked" not in sql(Segment()).replace("users.bot_blocked", "")
+
+
+def test_notblocked_leaves_out_users_blocked_by_an_admin():
+    segment = Segment.parse(["notblocked", "joined"])
+    assert str(segment) == "notblocked joined"
+    assert "users.blocked = false" in sql(segment)
+    assert Segment.from_json(segment.to_json()).filters == segment.filters
+
+
+@pytest.mark.parametrize("words", [["notblocked=yes"], ["since=yesterday"], ["unknown"]])
+def test_invalid_filters(words):
+    with pytest.raises(SegmentError):
+        Segment.parse(words)
@@ -0,0 +1,32 @@
+import pytest
+
+from cache import create_user_cache, _InstrumentedTTLCache
+
+
+@pytest.mark.parametrize("policy", ["ttl", "lru", "lfu"])
+def test_eviction(policy):
+    cache = create_user_cache(policy, maxsize=2, ttl=60)
+    cache[1] = "a"
+    cache[2] = "b"
+    assert cache[1] == "a"
+    cache[3] = "c"
+    assert len(cache) == 2 and 3 in cache
+    assert cache.evictions == 1
+    assert cache.expirations == 0
+
+
+def test_expiration():
+    now = [0]
+    cache = _InstrumentedTTLCache(maxsize=10, ttl=60, timer=lambda: now[0])
+    cache[1] = "a"
+    cache[2] = "b"
+    now[0] = 61
+    cache[3] = "c"
+    assert 1 not in cache and 2 not in cache and cache[3] == "c"
+    assert cache.expirations == 2
+    assert cache.evictions == 0
+
+
+def test_invalid_policy():
+    with pytest.raises(ValueError):
+        create_user_cache("fifo")
@@ -0,0 +1,199 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+import database
+from database import User, Payout
+from payments.solana import SignedTransaction, SentTransaction
+from payments.wallet import NotEnoughBalanceError, PrivateKeyNoneError, TransactionUnknownError
+from payouts import PayoutQueue, PayoutConflictError
+from session import create_engine
+
+
+class Batcher:
+    """Stands in for PayoutBatcher, failing each transfer with errors[address] before or after signing it."""
+
+    def __init__(self):
+        self.wallet = SimpleNamespace(key="key")
+        self.errors = {}
+        self.signed = set()
+
+    async def transfer(self, address, amount, on_signed=None):
+        error, after_signing = self.errors.get(address, (None, False))
+        if error is not None and not after_signing:
+            raise error
+        signed = SignedTransaction(f"sig-{address}", "blockhash", f"url-{address}", b"", 0)
+        await on_signed(signed)
+        self.signed.add(address)
+        if error is not None:
+            raise error
+        return SentTransaction(signed.signature, signed.blockhash, signed.url)
+
+
+def run(tmp_path, test, **kwargs):
+    """Run test(queue, session_factory) against a fresh database with a user 1 owning a balance of 10."""
+    async def main():
+        engine = create_engine(f"sqlite:///{tmp_path}/test.sqlite")
+        async with engine.begin() as connection:
+            await connection.run_sync(database.TableDeclarativeBase.metadata.create_all)
+        session_factory = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+        async with session_factory() as session:
+            telegram_user = SimpleNamespace(id=1, first_name="A", last_name=None, username=None, language_code="en")
+            session.add(User(telegram_user, language="en", reward=10, claimed=0, wallet="wallet"))
+            await session.commit()
+        queue = PayoutQueue(session_factory, Batcher(), max_attempts=2, retry_delay=0, **kwargs)
+        try:
+            await test(queue, session_factory)
+        finally:
+            await engine.dispose()
+
+    asyncio.run(main())
+
+
+async def get_user(session_factory) -> User:
+    async with session_factory() as session:
+        return await session.get(User, 1)
+
+
+async def get_payouts(session_factory) -> list:
+    async with session_factory() as session:
+        result = await session.execute(select(Payout).order_by(Payout.payout_id))
+        return result.scalars().all()
+
+
+async def process_due(queue):
+    for payout in await queue._claim_due(10):
+        await queue._process(payout)
+
+
+def test_enqueue_claims_the_balance(tmp_path):
+    async def test(queue, session_factory):
+        payout = await queue.enqueue(await get_user(session_factory))
+        assert payout.amount == 10 and payout.status == "queued"
+        user = await get_user(session_factory)
+        assert user.claimed == 10 and user.balance == 0
+
+    run(tmp_path, test)
+
+
+def test_stale_balance_is_refused(tmp_path):
+    async def test(queue, session_factory):
+        user = await get_user(session_factory)
+        await queue.enqueue(user)
+        # The balance was read before the first withdrawal claimed it
+        with pytest.raises(PayoutConflictError):
+            await queue.enqueue(user)
+        assert (await get_user(session_factory)).claimed == 10
+        assert len(await get_payouts(session_factory)) == 1
+
+    run(tmp_path, test)
+
+
+def test_concurrent_withdrawals_pay_once(tmp_path):
+    async def test(queue, session_factory):
+        user = await get_user(session_factory)
+        results = await asyncio.gather(queue.enqueue(user), queue.enqueue(user), return_exceptions=True)
+        assert sum(isinstance(result, PayoutConflictError) for result in results) == 1
+        assert (await get_user(session_factory)).claimed == 10
+        assert len(await get_payouts(session_factory)) == 1
+
+    run(tmp_path, test)
+
+
+def test_sent(tmp_path):
+    async def test(queue, session_factory):
+        await queue.enqueue(await get_user(session_factory))
+        await process_due(queue)
+        payout, = await get_payouts(session_factory)
+        assert payout.status == "sent" and payout.signature == "sig-wallet" and payout.attempts == 1
+
+    run(tmp_path, test)
+
+
+def test_refused_transfer_is_retried_then_refunded(tmp_path):
+    async def test(queue, session_factory):
+        queue.batcher.errors["wallet"] = (NotEnoughBalanceError(), False)
+        await queue.enqueue(await get_user(session_factory))
+        await process_due(queue)
+        payout, = await get_payouts(session_factory)
+        assert payout.status == "queued" and payout.attempts == 1
+        await process_due(queue)
+        payout, = await get_payouts(session_factory)
+        assert payout.status == "failed" and payout.attempts == 2
+        assert (await get_user(session_factory)).claimed == 0
+
+    run(tmp_path, test)
+
+
+def test_refund_releases_the_idempotency_key(tmp_path):
+    async def test(queue, session_factory):
+        queue.max_attempts = 1
+        queue.batcher.errors["wallet"] = (NotEnoughBalanceError(), False)
+        await queue.enqueue(await get_user(session_factory))
+        await process_due(queue)
+        # The same balance can be withdrawn again once it was given back
+        queue.batcher.errors.clear()
+        await queue.enqueue(await get_user(session_factory))
+        await process_due(queue)
+        failed, sent = await get_payouts(session_factory)
+        assert failed.status == "failed" and sent.status == "sent"
+        assert failed.idempotency_key != sent.idempotency_key
+        assert (await get_user(session_factory)).claimed == 10
+
+    run(tmp_path, test)
+
+
+def test_unexpected_error_before_signing_is_retried(tmp_path):
+    async def test(queue, session_factory):
+        queue.batcher.errors["wallet"] = (KeyError("boom"), False)
+        await queue.enqueue(await get_user(session_factory))
+        await process_due(queue)
+        payout, = await get_payouts(session_factory)
+        assert payout.status == "queued" and payout.signature is None
+
+    run(tmp_path, test)
+
+
+@pytest.mark.parametrize("error", [KeyError("boom"), TransactionUnknownError("timeout", "sig-wallet", "blockhash")])
+def test_error_after_signing_is_tracked(tmp_path, error):
+    async def test(queue, session_factory):
+        queue.batcher.errors["wallet"] = (error, True)
+        await queue.enqueue(await get_user(session_factory))
+        await process_due(queue)
+        payout, = await get_payouts(session_factory)
+        assert payout.status == "sent" and payout.signature == "sig-wallet"
+        assert (await get_user(session_factory)).claimed == 10
+
+    run(tmp_path, test)
+
+
+def test_missing_key_does_not_use_attempts(tmp_path):
+    async def test(queue, session_factory):
+        queue.batcher.errors["wallet"] = (PrivateKeyNoneError(), False)
+        await queue.enqueue(await get_user(session_factory))
+        for _ in range(3):
+            await process_due(queue)
+        payout, = await get_payouts(session_factory)
+        assert payout.status == "queued" and payout.attempts == 0
+
+    run(tmp_path, test)
+
+
+def test_recover(tmp_path):
+    async def test(queue, session_factory):
+        async with session_factory() as session:
+            session.add_all([
+                Payout(user_id=1, idempotency_key="1:0", wallet="wallet", amount=1, status="sending",
+                       signature="sig", blockhash="blockhash"),
+                Payout(user_id=1, idempotency_key="1:1", wallet="wallet", amount=1, status="sending"),
+            ])
+            await session.commit()
+        assert await queue.recover() == 2
+        signed, unsigned = await get_payouts(session_factory)
+        assert signed.status == "sent" and unsigned.status == "queued"
+
+    run(tmp_path, test)
@@ -0,0 +1,92 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+
+from payments.rpc import RPCClient, RPCError, RPCTransportError
+
+
+def make_client(handlers, **kwargs):
+    """An RPCClient on the endpoints http://<name>, each answered by handlers[name](request)."""
+    calls = []
+
+    def handle(request):
+        calls.append(request.url.host)
+        return handlers[request.url.host](request)
+
+    http = httpx.AsyncClient(transport=httpx.MockTransport(handle))
+    client = RPCClient([f"http://{name}" for name in handlers], http=http, **kwargs)
+    return client, calls
+
+
+def result(value):
+    return lambda request: httpx.Response(200, json={"jsonrpc": "2.0", "id": 1, "result": {"value": value}})
+
+
+def node_error(message):
+    return lambda request: httpx.Response(200, json={"jsonrpc": "2.0", "id": 1,
+                                                     "error": {"code": -32002, "message": message}})
+
+
+def down(request):
+    raise httpx.ConnectError("connection refused", request=request)
+
+
+def test_failover():
+    client, calls = make_client({"a": down, "b": result(42)})
+    assert asyncio.run(client.get_balance("address")) == 42
+    assert calls == ["a", "b"]
+    a, b = client.endpoints
+    assert a.failures == 1 and a.error_rate > 0
+    assert b.failures == 0 and b.error_rate == 0
+
+
+def test_breaker_opens_and_closes():
+    handlers = {"a": down, "b": result(42)}
+    client, calls = make_client(handlers, failure_threshold=2, cooldown=0.1)
+    a, b = client.endpoints
+
+    async def requests(count):
+        for _ in range(count):
+            await client.get_balance("address")
+
+    # a is tried until it fails failure_threshold times in a row, then skipped
+    asyncio.run(requests(2))
+    assert not a.available(time.monotonic())
+    calls.clear()
+    asyncio.run(requests(3))
+    assert calls == ["b", "b", "b"]
+
+    # After the cooldown a gets a request again, and a success closes its circuit
+    time.sleep(0.1)
+    handlers["a"] = result(7)
+    b.latency = 1.0
+    calls.clear()
+    assert asyncio.run(client.get_balance("address")) == 7
+    assert calls == ["a"]
+    assert a.available(time.monotonic()) and a.failures == 0
+
+
+def test_node_error_is_not_retried():
+    client, calls = make_client({"a": node_error("invalid transaction"), "b": result(42)})
+    with pytest.raises(RPCError) as error:
+        asyncio.run(client.get_balance("address"))
+    assert not isinstance(error.value, RPCTransportError)
+    assert calls == ["a"]
+    assert client.endpoints[0].failures == 0
+
+
+def test_every_endpoint_down_is_a_transport_error():
+    client, calls = make_client({"a": down, "b": down})
+    with pytest.raises(RPCTransportError):
+        asyncio.run(client.get_balance("address"))
+    assert calls == ["a", "b"]
+
+
+def test_node_error_after_failover_is_a_transport_error():
+    # a may have processed the transaction before failing, so b rejecting it says nothing about the outcome
+    client, calls = make_client({"a": down, "b": node_error("already processed")})
+    with pytest.raises(RPCTransportError):
+        asyncio.run(client.send_transaction(b"transaction"))
+    assert calls == ["a", "b"]
@@ -1,5 +1,9 @@
+import asyncio
+import logging
 import random
 
+log = logging.getLogger(__name__)
+
 
 def telegram_html_escape(string: str):
     return string.replace("<", "&lt;") \
@@ -8,6 +12,16 @@ def telegram_html_escape(string: str):
         .replace('"', "&quot;")
 
 
+async def run_periodically(interval: float, function, *args):
+    """Await function(*args) every interval seconds, until the task running this is cancelled."""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await function(*args)
+        except Exception as e:
+            log.error(f"Periodic task {function.__qualname__} failed: {e}")
+
+
 # Function to generate four options for the user to select
 def generate_options(correct_sum):
     # Generate three random incorrect options
@@ -79,13 +93,21 @@ class Vars:
         self.min_reward_amount: float = 0
         self.ad_button_name: str = "🗞 Advertise Your Project Here"
         self.ad_button_url: str = "https://t.me/+EA5ZPGTwt1AxNzQ1"
+        # bumped on every update, so that what is built from the variables can be cached per version
+        self._version: int = 0
 
     def __str__(self):
         text = ""
         for key, val in vars(self).items():
+            if key.startswith("_"):
+                continue
             text += f"{key}: {val}" '\n'
         return text
 
+    @property
+    def version(self) -> int:
+        return self._version
+
     def available(self):
         for key, val in vars(self):
             if val is None:
@@ -109,3 +131,4 @@ class Vars:
             self.ad_button_name = value
         elif cmd == AdminCommands.SET_AD_URL:
             self.ad_button_url = value
+        self._version += 1